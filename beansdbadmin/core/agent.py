@@ -2,15 +2,17 @@
 # encoding: utf-8
 
 import os
+import json
 import time
 import logging
 import subprocess
 import psutil
 import getpass
 import atexit
+import threading
 import beansdbadmin.core.log as log
 
-from collections import defaultdict
+from collections import defaultdict, Counter
 from beansdbadmin.lib.bottle import route, run, request, redirect
 from beansdbadmin.core.conf import get_server_conf
 from beansdbadmin.core.zookeeper import ZK
@@ -20,10 +22,14 @@ from beansdbadmin.core.path import (
     get_disk_info as _get_disk_info,
     get_data_files as _get_data_files,
     du as get_du,
-    get_disk_free
+    dir_sizes,
+    get_disk_free,
+    DiskUtil
 )
 from beansdbadmin.core.node import (
     Node, ERR_SPACE, ERR_RSYNC_WORKING, ERR_RSYNC_NOT_DONE)
+from beansdbadmin.core.garbage import estimate_gc
+from beansdbadmin.core.scrub import Scrubber, SCRUB_RATE
 
 
 log.basicConfig()
@@ -36,7 +42,7 @@ zk_conf = ''
 def kill_rsync_clients():
     for bucket, st in RsyncState.buckets.items():
         if st.proc:
-            logger.warn("kill rsync for bucket %d", bucket)
+            logger.warn("kill rsync for bucket %s", bucket)
             st.proc.kill()
 
     logger.warn("agent killed")
@@ -48,6 +54,20 @@ DB_HOME = '/var/lib/beansdb'
 DB_DEPTH = 2
 cluster_name = None
 
+# rsync queue
+RSYNC_BWLIMIT = 60000  # KB, for a disk not measured yet
+RSYNC_BWLIMIT_MIN = 10000
+RSYNC_BWLIMIT_MAX = 200000
+RSYNC_MAX_UTIL = 0.8  # slow down above it, no new rsync to the disk
+RSYNC_PER_DISK = 1  # running rsyncs to a local disk
+RSYNC_PER_SRC_DISK = 1  # running rsyncs from a disk of a source server
+RSYNC_SCHEDULE_INTERVAL = 5
+
+# garbage estimates
+GARBAGE_TTL = 1800  # seconds an estimate is served before recomputed
+
+scrubber = None
+
 
 # server
 
@@ -131,6 +151,7 @@ class RsyncState(object):
 
         self.src = ""
         self.src_du = 0
+        self.src_disk = None  # (host, disk) the bucket is read from
 
         self.proc = None
         self.rc = -1  # < 0: new, None: running, 0: ok, > 0: err
@@ -138,6 +159,9 @@ class RsyncState(object):
 
         self.err = None
         self.commited = False
+        self.queued = False
+        self.killed = False
+        self.bwlimit = 0
 
         self.update_state()
 
@@ -169,6 +193,7 @@ class RsyncState(object):
 
         logger.info("rename %s -> %s", self.tmp, self.real)
         os.rename(self.tmp, self.real)
+        dir_sizes.forget(self.tmp)
         logger.info("link %s -> %s", self.link, self.real)
         os.symlink(self.real, self.link)
         self.finish_time = time.time()
@@ -178,6 +203,8 @@ class RsyncState(object):
                           'dstate': self.dstate,
                           'du': self.du,
                           'rc': self.rc,
+                          'queued': self.queued,
+                          'bwlimit': self.bwlimit,
                           'finish_time': self.finish_time},
                 'err': err or self.err}
 
@@ -196,9 +223,10 @@ class RsyncState(object):
             self.err = "%s" % e
             return False
 
-    def start_rsync(self):
-        bwlimit = 60000  # KB
+    def start_rsync(self, bwlimit=RSYNC_BWLIMIT):
+        '''rsync can not change its bwlimit once started, it is kept'''
         drop_cache = True
+        self.bwlimit = bwlimit
         self.proc = self.src.rsync_client().rsync(self.bucket_path, self.rsync_home, bwlimit, drop_cache=drop_cache)
         self.rc = self.proc.poll()
         time.sleep(1)
@@ -206,7 +234,7 @@ class RsyncState(object):
         self.update_state()
         logging.info("rsync client start: %s", self.summary())
 
-        if self.rc is None or self.rc == 0:
+        if (self.rc is None or self.rc == 0) and not self.killed:
             RsyncState.buckets[self.bucket] = self
 
     def update_state(self):
@@ -222,6 +250,195 @@ class RsyncState(object):
         return not self.finish_time and not self.err and self.rc is None
 
 
+class DiskIO(DiskUtil):
+    '''utilization of a disk and the bwlimit of rsyncs to it'''
+
+    def __init__(self, disk):
+        DiskUtil.__init__(self, disk)
+        self.bwlimit = RSYNC_BWLIMIT
+
+    def adapt(self):
+        ''' bwlimit for the next rsync to the disk '''
+        if self.util > RSYNC_MAX_UTIL:
+            self.bwlimit = max(RSYNC_BWLIMIT_MIN, self.bwlimit * 3 // 4)
+        elif self.util < RSYNC_MAX_UTIL / 2:
+            self.bwlimit = min(RSYNC_BWLIMIT_MAX, self.bwlimit * 5 // 4)
+
+    def summary(self):
+        return {'device': self.device,
+                'util': round(self.util, 3),
+                'bwlimit': self.bwlimit}
+
+
+def get_src_disk(src, bucket):
+    '''(host, disk) of bucket on the source node, by its agent,
+    (host, None) if unknown'''
+    try:
+        disks = json.loads(src.agent_client().disks())['disks']
+    except Exception:
+        logger.exception("get disks of %s failed", src)
+        return (src.host, None)
+    found = sorted(d for (d, info) in disks.items()
+                   if bucket[0] in info['buckets'] or bucket in info['buckets'])
+    return (src.host, found[0] if found else None)
+
+
+class RsyncQueue(object):
+    '''rsync starts wait here, and are started at most RSYNC_PER_DISK per
+    local disk and RSYNC_PER_SRC_DISK per disk of a source server, to disks
+    not busier than RSYNC_MAX_UTIL, with a bwlimit adapted to the disk
+    utilization.
+
+    the bwlimit is adapted for rsyncs to start, a running rsync keeps the
+    one it was started with; a busy disk gets no new rsync until it is
+    below RSYNC_MAX_UTIL again.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = []
+        self.disks = dict()
+        self.thread = None
+
+    def get_io(self, disk):
+        io = self.disks.get(disk)
+        if io is None:
+            io = self.disks[disk] = DiskIO(disk)
+        return io
+
+    def add(self, st):
+        with self.lock:
+            self.remove(st.bucket)
+            st.queued = True
+            self.queue.append(st)
+            RsyncState.buckets[st.bucket] = st
+
+    def remove(self, bucket):
+        self.queue = [st for st in self.queue if st.bucket != bucket]
+
+    def schedule(self):
+        to_start = []
+        with self.lock:
+            on_disk = Counter()
+            on_src = Counter()
+            for st in RsyncState.buckets.values():
+                if st.proc is not None and st.is_running():
+                    st.update_state()
+                if st.proc is not None and st.is_running():
+                    on_disk[st.disk] += 1
+                    on_src[st.src_disk] += 1
+
+            disks = set(on_disk) | set([st.disk for st in self.queue])
+            for disk in disks:
+                io = self.get_io(disk)
+                io.update()
+                io.adapt()
+
+            for st in list(self.queue):
+                io = self.get_io(st.disk)
+                if (on_disk[st.disk] >= RSYNC_PER_DISK or
+                        on_src[st.src_disk] >= RSYNC_PER_SRC_DISK or
+                        io.util > RSYNC_MAX_UTIL):
+                    continue
+                self.queue.remove(st)  # still queued until started
+                to_start.append((st, io.bwlimit))
+                on_disk[st.disk] += 1
+                on_src[st.src_disk] += 1
+
+        # start_rsync waits for the rsync, do not block rsync_kill meanwhile
+        for st, bwlimit in to_start:
+            if not st.killed and st.check_and_clear_dir():
+                st.start_rsync(bwlimit)
+            st.queued = False
+            with self.lock:
+                if st.killed and st.proc:
+                    st.proc.kill()
+
+    def run(self):
+        while True:
+            try:
+                self.schedule()
+            except Exception:
+                logger.exception("rsync schedule failed")
+            time.sleep(RSYNC_SCHEDULE_INTERVAL)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="rsync_queue")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def summary(self):
+        with self.lock:
+            running = [st.bucket for st in RsyncState.buckets.values()
+                       if st.proc is not None and st.is_running()]
+            return {'queue': [(st.bucket, st.disk, st.src_disk)
+                              for st in self.queue],
+                    'running': sorted(running),
+                    'disks': dict((d, io.summary())
+                                  for (d, io) in self.disks.items())}
+
+
+rsync_queue = RsyncQueue()
+
+
+class GarbageCache(object):
+    '''gc estimates of buckets, computed one at a time by a background
+    thread, as they take a scan of the whole khash index of a bucket;
+    an expired one is still served while it is recomputed.'''
+
+    def __init__(self, ttl=GARBAGE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.results = dict()  # (bucket, sample) -> (time, result)
+        self.pending = []
+        self.thread = None
+
+    def get(self, bucket, sample):
+        ''' return (time, result), (0, None) if not computed yet '''
+        key = (bucket, sample)
+        with self.lock:
+            t, res = self.results.get(key, (0, None))
+            if time.time() - t >= self.ttl and key not in self.pending:
+                self.pending.append(key)
+                self.cond.notify()
+            self.start()
+        return t, res
+
+    def compute(self, bucket, sample):
+        path = os.path.join(DB_HOME, "/".join(bucket))
+        if not os.path.isdir(path):
+            return {'err': 'no bucket %s' % bucket}
+        return estimate_gc(path, sample)
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.cond.wait()
+                bucket, sample = self.pending[0]
+            start = time.time()
+            try:
+                res = self.compute(bucket, sample)
+            except Exception as e:
+                logger.exception("estimate garbage of %s failed", bucket)
+                res = {'err': str(e)}
+            logger.info("estimate garbage of %s %.1fs", bucket,
+                        time.time() - start)
+            with self.lock:
+                self.results[(bucket, sample)] = (time.time(), res)
+                self.pending.pop(0)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="garbage")
+            self.thread.daemon = True
+            self.thread.start()
+
+
+garbage_cache = GarbageCache()
+
+
 # for multi buckets, e.g. "01,0a,1b"
 @route('/rsync/prepare')
 def rsync_prepare():
@@ -250,21 +467,32 @@ def rsync_start(bucket):
     src = Node(request.query['src'])
 
     st = RsyncState.buckets.get(bucket)
-    if st and st.running():
+    if st and (st.is_running() or st.queued):
         return st.summary(ERR_RSYNC_WORKING)
     # 如果不是在跑的，会直接覆盖
 
     st = RsyncState(bucket, disk)
     st.src = src
     st.src_du = size
+    src_disk = request.query.get('src_disk')
+    if src_disk:
+        st.src_disk = (src.host, src_disk)
+    else:
+        st.src_disk = get_src_disk(src, bucket)
 
     if st.dstate == 2:
         return st.summary("not_empty")
     elif st.check_and_clear_dir():
-        st.start_rsync()
+        # started by rsync_queue when the disks allow
+        rsync_queue.add(st)
     return st.summary()
 
 
+@route('/rsync/queue')
+def rsync_queue_state():
+    return rsync_queue.summary()
+
+
 @route('/rsync/state/<bucket>')
 def rsync_state(bucket):
     if bucket == "all":
@@ -293,9 +521,12 @@ def rsync_commit(bucket):
 def rsync_kill(bucket):
     st = RsyncState.buckets.get(bucket)
     if st:
-        if st.proc:
-            st.proc.kill()
-        RsyncState.buckets.pop(bucket)
+        with rsync_queue.lock:
+            rsync_queue.remove(bucket)
+            st.killed = True
+            if st.proc:
+                st.proc.kill()
+            RsyncState.buckets.pop(bucket)
         return st.summary()
     else:
         return {}
@@ -315,6 +546,26 @@ def get_buckets():
     return {'buckets': get_bucket_info()}
 
 
+# estimated in background, return the last estimate and its age,
+# {'pending': True} until there is one
+@route('/garbage/<bucket>')
+def get_garbage(bucket):
+    sample = int(request.query.get('sample', default=1))
+    t, res = garbage_cache.get(bucket, sample)
+    if res is None:
+        return {'pending': True}
+    res = dict(res)
+    res['age'] = int(time.time() - t)
+    return res
+
+
+@route('/scrub')
+def get_scrub():
+    if scrubber is None:
+        return {'err': 'scrub not enabled'}
+    return scrubber.summary()
+
+
 @route('/disk_info')
 def get_server_info():
     return _get_server_info(zk=zk_client(zk_conf))
@@ -399,11 +650,14 @@ def zk_client(zk_cluster):
 
 
 def main():
-    global confdir, DB_HOME, cluster_name, zk_conf
+    global confdir, DB_HOME, cluster_name, zk_conf, scrubber
 
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--confdir')
+    parser.add_argument('--scrub-rate', type=int, default=SCRUB_RATE >> 20,
+                        help="MB/s per disk to verify crc of data files, 0 to disable")
+    parser.add_argument('--scrub-db', help="default <home>/scrub.db")
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO,
@@ -424,6 +678,11 @@ def main():
     if not os.environ.get('BOTTLE_CHILD'):  # not restart when reload
         logging.info("start rsyncd ok: %s", start_rsyncd(me.rsync_client().port))
 
+    rsync_queue.start()
+    if args.scrub_rate > 0:
+        scrub_db = args.scrub_db or os.path.join(DB_HOME, "scrub.db")
+        scrubber = Scrubber([DB_HOME], DB_DEPTH, scrub_db, args.scrub_rate << 20)
+        scrubber.start()
     run(host="0.0.0.0", port=me.agent_client().port, reloader=False, debug=True)
 
 
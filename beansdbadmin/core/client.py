@@ -11,17 +11,17 @@ import telnetlib
 import logging
 import libmc
 import string
-import urllib
 import itertools
 import warnings
 from collections import defaultdict
-from beansdbadmin.core.hint import parse_new_hint_body
+from beansdbadmin.core.hint import parse_new_hint_body, parse_new_hint_columns
 from beansdbadmin.core.data import parse_records
 from beansdbadmin.core.hash import get_khash64
+from beansdbadmin.core.http_pool import get_url
 
 
-def get_url_content(url):
-    return urllib.urlopen(url).read()
+def get_url_content(url, retry=True):
+    return get_url(url, retry)
 
 
 def check_bucket(bucket):
@@ -156,8 +156,8 @@ class MCStore(object):
             raise Exception(str(rev))
         return self.mc.set_raw(key, data, rev, flag)
 
-    def set_multi(self, values, return_failure=False):
-        return self.mc.set_multi(values, return_failure=return_failure)
+    def set_multi(self, values, return_failure=False, rev=0):
+        return self.mc.set_multi(values, rev, return_failure=return_failure)
 
     def _check_last_error(self):
         last_err = self.mc.get_last_error()
@@ -222,15 +222,37 @@ class DBClient(MCStore):
         return (int(count), int(hcount), int(khash, 16), int(data_size))
 
     def get_collision(self, bucket):
+        '''{khash: {key: (vhash, ver)}} of the khashes of more than one
+        key in the collision table of bucket'''
         check_bucket(bucket)
         collisions = defaultdict(dict)
         hint_data = self.get("@collision_all_%x" % bucket)
         if hint_data is None:
             return dict()
-        for key, meta, _ in parse_new_hint_body(hint_data):
-            khash_str, _, ver, vhash = meta
-            collisions[khash_str][key] = (vhash, ver)
-        return dict(collisions)
+        columns = parse_new_hint_columns(hint_data)
+        if columns is not None:
+            # only keys of the colliding rows are sliced out
+            rows = columns.colliding()
+            items = columns.items[rows]
+            for khash, key, ver, vhash in zip(items['khash'].tolist(),
+                                              columns.keys(rows),
+                                              items['ver'].tolist(),
+                                              items['vhash'].tolist()):
+                collisions[khash][key] = (vhash, ver)
+        else:
+            for key, meta, _ in parse_new_hint_body(hint_data):
+                khash_str, _, ver, vhash = meta
+                collisions[khash_str][key] = (vhash, ver)
+        return dict((khash, keys) for khash, keys in collisions.iteritems()
+                    if len(keys) > 1)
+
+    def get_collision_columns(self, bucket):
+        '''HintColumns of all collisions, None if numpy is not installed'''
+        check_bucket(bucket)
+        hint_data = self.get("@collision_all_%x" % bucket)
+        if hint_data is None:
+            return None
+        return parse_new_hint_columns(hint_data)
 
     def get_records_by_khash_raw(self, khash):
         if self.is_old():
@@ -246,6 +268,15 @@ class DBClient(MCStore):
         else:
             return []
 
+    def get_records_by_khash_multi(self, khashes):
+        '''return {khash_str: records}, by one get_multi of @@khash'''
+        if self.is_old():
+            return {}
+        khashes = [k if isinstance(k, str) else "%016x" % k for k in khashes]
+        raws = self.get_multi(["@@" + k for k in khashes])
+        return dict((k[2:], parse_records(raw, False))
+                    for (k, raw) in raws.iteritems() if raw)
+
     def start_gc(self, bucket='', start_fid=0, end_fid=None):
         """ bucket must be in 0 or 00 string """
         if bucket:
@@ -345,6 +376,11 @@ class DBClient(MCStore):
             content = ''
         return dir_to_dict(content)
 
+    def get_dir_multi(self, paths):
+        ''' return {path: dict like get_dir} in one request '''
+        contents = self.get_multi(paths)
+        return dict((p, dir_to_dict(contents.get(p))) for p in paths)
+
     def list_dir(self, d):  # FIXME: d should not need prefix @?
         '''list all KEY in the dir!
         not use it if dir is large!'''
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''offline compaction of a bucket: rewrite only its live records into new
+data files and hints in another dir, e.g. for disks of a dead node, whose
+gobeansdb can not gc them.
+
+    python -m beansdbadmin.core.compact /data1/beansdb/0/a [out_dir]
+
+the output dir (default <bucket_dir>.compact) keeps a state file,
+a killed run continues from it:
+
+    live: stream the live (chunk, pos) of the bucket's khash index to a
+          position file per source chunk, memory is bounded by the write
+          buffer, not by the number of keys; the index is built in the
+          output dir, the bucket may be on a read-only mount
+    copy: copy the live records of each source chunk, in pos order, to
+          output chunks with write_record, and write a hint of each output
+          chunk; the state is saved after each output chunk
+
+source chunks are read with plain seek and read, not a mmap, as bad
+sectors are to be expected on such disks: a read error is a bad record,
+logged and counted, where under a mmap it would be a SIGBUS.
+'''
+
+import os
+import re
+import json
+import array
+import shutil
+import logging
+from collections import defaultdict
+
+from beansdbadmin.core.data import (
+    read_record, write_record, get_record_size, decompress,
+    FLAG_COMPRESS, R_KEY, R_VSZ, R_VALUE, R_FLAG, R_TS, R_VER)
+from beansdbadmin.core.hint import write_new_hint, get_new_hint_name
+from beansdbadmin.core.hash import get_khash64, get_vhash
+from beansdbadmin.core.path import make_basename
+from beansdbadmin.core.khash_index import E_CHUNK, E_POS
+from beansdbadmin.core.export import (
+    get_data_chunks, iter_live_entries, DATA_FILE_MAX)
+
+STATE_FILE = 'compact.json'
+LIVE_DIR = 'live'
+LIVE_BUFFER = 1 << 20  # positions buffered before written to files
+SRC_INDEX = 'src.kidx'  # in LIVE_DIR
+
+output_name_regx = re.compile(r'^([0-9]{3})\.(data|[0-9]{3}\.idx\.s)(\.tmp)?$')
+
+STEP_LIVE = 'live'
+STEP_COPY = 'copy'
+STEP_DONE = 'done'
+
+
+class ChunkWriter(object):
+    '''an output data file and the items of its hint'''
+
+    def __init__(self, out_dir, chunk, max_file_size):
+        self.out_dir = out_dir
+        self.chunk = chunk
+        self.max_file_size = max_file_size
+        self.f = None
+        self.size = 0
+        self.items = []
+
+    def is_full(self, rsize):
+        return self.size > 0 and self.size + rsize > self.max_file_size
+
+    def write(self, rec):
+        key, value, flag = rec[R_KEY], rec[R_VALUE], rec[R_FLAG]
+        if self.f is None:
+            name = make_basename(self.chunk, 'data')
+            if name is None:
+                raise ValueError("too many chunks: %d" % self.chunk)
+            self.f = open(os.path.join(self.out_dir, name), 'wb')
+        if flag & FLAG_COMPRESS:
+            vhash = get_vhash(decompress(value))
+        else:
+            vhash = get_vhash(value)
+        self.items.append((key, get_khash64(key), self.chunk, self.size,
+                           rec[R_VER], vhash))
+        self.size += write_record(self.f, key, value, flag, rec[R_TS],
+                                  rec[R_VER])
+
+    def finish(self):
+        ''' close the data file and write its hint, False if empty '''
+        if self.f is None:
+            return False
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        self.f = None
+        write_new_hint(os.path.join(self.out_dir, get_new_hint_name(self.chunk)),
+                       self.items, self.size)
+        self.items = []
+        return True
+
+
+class Compactor(object):
+
+    def __init__(self, bucket_dir, out_dir=None, max_file_size=DATA_FILE_MAX):
+        self.bucket_dir = bucket_dir
+        self.out_dir = out_dir or bucket_dir.rstrip('/') + '.compact'
+        self.max_file_size = max_file_size
+        self.state_path = os.path.join(self.out_dir, STATE_FILE)
+        self.stats = dict(count=0, bad=0, size=0, chunks=0)
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        self.state = self.load_state()
+
+    def load_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                return json.load(f)
+        return {'step': STEP_LIVE}
+
+    def save_state(self, **state):
+        self.state = state
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, self.state_path)
+
+    def get_live_path(self, chunk):
+        return os.path.join(self.out_dir, LIVE_DIR, '%03d.pos' % chunk)
+
+    def find_live(self):
+        live_dir = os.path.join(self.out_dir, LIVE_DIR)
+        if os.path.exists(live_dir):
+            shutil.rmtree(live_dir)  # from a killed run
+        os.makedirs(live_dir)
+        buf = defaultdict(lambda: array.array('I'))
+        n = 0
+        index_path = os.path.join(live_dir, SRC_INDEX)
+        for e in iter_live_entries(self.bucket_dir, index_path):
+            buf[e[E_CHUNK]].append(e[E_POS])
+            n += 1
+            if n >= LIVE_BUFFER:
+                self._flush_live(buf)
+                n = 0
+        self._flush_live(buf)
+        self.save_state(step=STEP_COPY, src=[0, 0], out_chunk=0)
+
+    def _flush_live(self, buf):
+        for chunk, positions in buf.items():
+            with open(self.get_live_path(chunk), 'ab') as f:
+                positions.tofile(f)
+        buf.clear()
+
+    def load_live(self, chunk):
+        positions = array.array('I')
+        path = self.get_live_path(chunk)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                positions.fromstring(f.read())
+        return array.array('I', sorted(positions))
+
+    def clear_output(self, out_chunk):
+        ''' remove output chunks written after the saved state '''
+        for name in os.listdir(self.out_dir):
+            m = output_name_regx.match(name)
+            if m is not None and int(m.group(1)) >= out_chunk:
+                logging.info("remove %s of a killed run", name)
+                os.remove(os.path.join(self.out_dir, name))
+
+    def copy(self):
+        src_chunk, src_i = self.state['src']
+        self.clear_output(self.state['out_chunk'])
+        chunks = get_data_chunks(self.bucket_dir)
+        writer = ChunkWriter(self.out_dir, self.state['out_chunk'],
+                             self.max_file_size)
+        for chunk in sorted(c for c in chunks if c >= src_chunk):
+            positions = self.load_live(chunk)
+            start = src_i if chunk == src_chunk else 0
+            with open(chunks[chunk], 'rb') as f:
+                for i in xrange(start, len(positions)):
+                    try:
+                        f.seek(positions[i], 0)
+                        rec = read_record(f, decompress_value=False)
+                        if rec is None:
+                            raise EOFError("truncated")
+                    except Exception as e:
+                        logging.error("%s: bad record at %x: %s",
+                                      chunks[chunk], positions[i], e)
+                        self.stats['bad'] += 1
+                        continue
+                    rsize = get_record_size(len(rec[R_KEY]), rec[R_VSZ])
+                    if writer.is_full(rsize):
+                        self.finish_chunk(writer)
+                        self.save_state(step=STEP_COPY, src=[chunk, i],
+                                        out_chunk=writer.chunk + 1)
+                        writer = ChunkWriter(self.out_dir, writer.chunk + 1,
+                                             self.max_file_size)
+                    writer.write(rec)
+                    self.stats['count'] += 1
+                    self.stats['size'] += rsize
+        self.finish_chunk(writer)
+        shutil.rmtree(os.path.join(self.out_dir, LIVE_DIR))
+        self.save_state(step=STEP_DONE, out_chunk=writer.chunk + 1)
+
+    def finish_chunk(self, writer):
+        if writer.finish():
+            self.stats['chunks'] += 1
+            logging.info("compacted %s chunk %d, %s", self.bucket_dir,
+                         writer.chunk, self.stats)
+
+    def run(self):
+        ''' return stats of this run '''
+        if self.state['step'] == STEP_LIVE:
+            self.find_live()
+        if self.state['step'] == STEP_COPY:
+            self.copy()
+        return self.stats
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="rewrite only the live records of a bucket")
+    parser.add_argument('--max-file-size', type=int, default=DATA_FILE_MAX >> 20,
+                        help="MB of an output data file")
+    parser.add_argument('bucket_dir')
+    parser.add_argument('out_dir', nargs='?')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    c = Compactor(args.bucket_dir, args.out_dir, args.max_file_size << 20)
+    stats = c.run()
+    logging.info("%s -> %s: %s", args.bucket_dir, c.out_dir, stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,9 @@
 record = (key, vsz, value, flag, tstamp, ver)
 '''
 
+import os
 import sys
+import mmap
 import struct
 import logging
 import quicklz
@@ -39,6 +41,7 @@ PADDING = 256
 ## settings
 MAX_VALUE_SIZE = (100 << 20)
 MAX_KEY_LEN = 250
+READ_ERROR_SKIP = 4096  # a disk sector, skipped after a read error
 
 
 class BadRecord(Exception):
@@ -143,17 +146,110 @@ def read_record(f, decompress_value=True, check_crc=True):
     return (key, vsz, value, flag, tstamp, ver)
 
 
+def read_record_key(f):
+    '''read only the header and key of a rec from f and seek over the value,
+    value in the rec is None and crc is not checked'''
+    pos = f.tell()
+    block = f.read(PADDING)
+    if not block:
+        return
+    crc, tstamp, flag, ver, ksz, vsz = parse_header(block)
+    if not (0 < ksz <= MAX_KEY_LEN) or not 0 <= vsz <= MAX_VALUE_SIZE:
+        raise SizeError("size %d %d" % (ksz, vsz))
+    if REC_HEAD_SIZE + ksz > len(block):
+        block += f.read(REC_HEAD_SIZE + ksz - len(block))
+    key = block[REC_HEAD_SIZE:REC_HEAD_SIZE + ksz]
+    rsize = get_record_size(ksz, vsz)
+    if rsize > len(block):
+        f.seek(pos + rsize, 0)
+    return (key, vsz, None, flag, tstamp, ver)
+
+
+def read_record_at(buf, pos, decompress_value=True, check_crc=True,
+                   copy=True, skip_value=False):
+    '''read a rec in place from buf (e.g. a mmap) at pos,
+    key and value are buffer slices of buf unless copy,
+    with skip_value, value is None and crc is not checked,
+    return (rec, rsize), rec is None at the end of buf'''
+    if pos >= len(buf):
+        return None, 0
+    if pos + REC_HEAD_SIZE > len(buf):
+        raise SizeError("truncated header at %d" % pos)
+    crc, tstamp, flag, ver, ksz, vsz = struct.unpack_from("IiiiII", buf, pos)
+    if not (0 < ksz <= MAX_KEY_LEN) or not 0 <= vsz <= MAX_VALUE_SIZE:
+        raise SizeError("size %d %d" % (ksz, vsz))
+    rsize = get_record_size(ksz, vsz)
+    koff = pos + REC_HEAD_SIZE
+    if skip_value:
+        key = buf[koff:koff + ksz] if copy else buffer(buf, koff, ksz)
+        return (key, vsz, None, flag, tstamp, ver), rsize
+    if check_crc:
+        crc32 = binascii.crc32(buffer(buf, pos + 4, 20 + ksz + vsz)) & 0xffffffff
+        if crc != crc32:
+            raise CRCError("crc")
+    if copy:
+        key = buf[koff:koff + ksz]
+        value = buf[koff + ksz:koff + ksz + vsz]
+    else:
+        key = buffer(buf, koff, ksz)
+        value = buffer(buf, koff + ksz, vsz)
+    if decompress_value and (flag & FLAG_COMPRESS):
+        value = quicklz.decompress(str(value))
+        flag -= FLAG_COMPRESS
+    return (key, vsz, value, flag, tstamp, ver), rsize
+
+
+def find_next_record(buf, pos):
+    '''return the first PADDING aligned pos >= pos in buf where a record
+    with sane sizes and a valid crc starts, len(buf) if there is none'''
+    size = len(buf)
+    if pos & (PADDING - 1):
+        pos = (pos | (PADDING - 1)) + 1
+    while pos + REC_HEAD_SIZE <= size:
+        ksz, vsz = struct.unpack_from("II", buf, pos + 16)
+        if (0 < ksz <= MAX_KEY_LEN and 0 <= vsz <= MAX_VALUE_SIZE and
+                pos + REC_HEAD_SIZE + ksz + vsz <= size):
+            crc, = struct.unpack_from("I", buf, pos)
+            crc32 = binascii.crc32(buffer(buf, pos + 4, 20 + ksz + vsz))
+            if crc == crc32 & 0xffffffff:
+                return pos
+        pos += PADDING
+    return size
+
+
+def find_next_record_in_file(f, pos, size):
+    '''like find_next_record, reading forward from the file f of size,
+    the region of a read error is skipped to the next READ_ERROR_SKIP'''
+    if pos & (PADDING - 1):
+        pos = (pos | (PADDING - 1)) + 1
+    while pos + REC_HEAD_SIZE <= size:
+        try:
+            f.seek(pos, 0)
+            block = f.read(REC_HEAD_SIZE)
+            crc, _, _, _, ksz, vsz = parse_header(block)
+            if (0 < ksz <= MAX_KEY_LEN and 0 <= vsz <= MAX_VALUE_SIZE and
+                    pos + REC_HEAD_SIZE + ksz + vsz <= size):
+                crc32 = binascii.crc32(block[4:])
+                crc32 = binascii.crc32(f.read(ksz + vsz), crc32)
+                if crc == crc32 & 0xffffffff:
+                    return pos
+        except (IOError, OSError):
+            logging.warning("read error in %s at %x", f.name, pos)
+            pos = (pos | (READ_ERROR_SKIP - 1)) + 1
+            continue
+        pos += PADDING
+    return size
+
+
 def get_first_record_timestamp(data_path):
-    with open(data_path, 'r') as f:
-        while True:
-            block = f.read(PADDING)
-            crc, tstamp, flag, ver, ksz, vsz = struct.unpack("IiiiII", block[:REC_HEAD_SIZE])
-            if not (0 < ksz <= MAX_KEY_LEN) or not 0 <= vsz <= MAX_VALUE_SIZE:
+    # 为了节省时间，不在这里验证 crc 值了，因为 doubanfs 的值可能比较大，
+    # 而且其备份是在 /backup 路径上，带宽较小。
+    with DataFile(data_path, stop_on_bad=False, skip_value=True) as f:
+        for (_, rec) in f:
+            if rec is None:
                 print >>sys.stderr, 'record error in %s' % data_path
                 continue
-            # 为了节省时间，不在这里验证 crc 值了，因为 doubanfs 的值可能比较大，
-            # 而且其备份是在 /backup 路径上，带宽较小。
-            return tstamp
+            return rec[R_TS]
 
 
 def filter_data_files(data_files, start_ts, stop_ts):
@@ -193,24 +289,64 @@ def filter_data_files(data_files, start_ts, stop_ts):
 
 
 class DataFile(object):
+    '''iterate (pos, rec) of a data file
+
+    with use_mmap, records are parsed in place from a read-only mmap of
+    the file instead of two f.read per record; with copy=False, key and
+    value are then buffer slices of the mmap, str() them to keep.
+    use_mmap is only for files on healthy disks: a bad sector under the
+    mmap is a SIGBUS which kills the process, no except can catch it.
+    nothing in the package uses it by default.
+
+    with skip_value, only the header and key of each record are read and
+    the value bytes are seeked over: value in recs is None, no crc check.
+
+    with resync and not stop_on_bad, after a bad record the scan goes on
+    from the next record found by find_next_record(_in_file), the bad
+    region is yielded as one (pos, None) and kept in skipped as
+    (start, end), instead of parsing every block after it as a record.
+    a read error (e.g. a bad sector) is then a bad region too, if the
+    file is not read with use_mmap.
+    '''
+
     def __init__(self, path, check_crc=True, decompress_value=True,
-                 stop_on_bad=True):
+                 stop_on_bad=True, use_mmap=False, copy=True,
+                 skip_value=False, resync=False):
         self.path = path
         self.stop_on_bad = stop_on_bad
         self.check_crc = check_crc
         self.decompress_value = decompress_value
+        self.copy = copy
+        self.skip_value = skip_value
+        self.resync = resync
 
         self.num_bad = 0
+        self.skipped = []
         self.f = open(path, 'r')
         self.last_err = None
 
+        self.mm = None
+        self._pos = 0
+        if use_mmap:
+            if os.fstat(self.f.fileno()).st_size > 0:
+                self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.mm = ''  # can not mmap an empty file
+
     def close(self):
+        if self.mm:
+            self.mm.close()
         self.f.close()
 
     def seek(self, pos):
+        if self.mm is not None:
+            self._pos = pos & 0xffffff00
+            return
         return self.f.seek(pos & 0xffffff00, 0)
 
     def pos(self):
+        if self.mm is not None:
+            return self._pos
         return self.f.tell()
 
     def get_last_error(self):
@@ -219,16 +355,50 @@ class DataFile(object):
     def __iter__(self):
         return self
 
+    def _read_mmap(self):
+        pos = self._pos
+        # on error, skip as far as read_record would have read
+        self._pos = pos + PADDING
+        rec, rsize = read_record_at(self.mm, pos, self.decompress_value,
+                                    self.check_crc, self.copy,
+                                    self.skip_value)
+        self._pos = pos + rsize
+        return rec
+
+    def _skip_bad_mmap(self, pos, e):
+        if isinstance(e, CRCError):
+            ksz, vsz = struct.unpack_from("II", self.mm, pos + 16)
+            self._pos = pos + get_record_size(ksz, vsz)
+
+    def _resync(self, pos):
+        if self.mm is not None:
+            self._pos = find_next_record(self.mm, pos + PADDING)
+            self.skipped.append((pos, self._pos))
+            return
+        size = os.fstat(self.f.fileno()).st_size
+        end = find_next_record_in_file(self.f, pos + PADDING, size)
+        self.f.seek(end, 0)
+        self.skipped.append((pos, end))
+
     def next(self):
         try:
             pos = self.pos()
-            rec = read_record(self.f, self.decompress_value, self.check_crc)
+            if self.mm is not None:
+                rec = self._read_mmap()
+            elif self.skip_value:
+                rec = read_record_key(self.f)
+            else:
+                rec = read_record(self.f, self.decompress_value, self.check_crc)
             if rec is None:
                 raise StopIteration()
             return (pos, rec)
         except StopIteration as e:
             raise e
         except Exception as e:
+            if self.resync:
+                self._resync(pos)
+            elif self.mm is not None:
+                self._skip_bad_mmap(pos, e)
             if self.stop_on_bad:
                 raise e
             else:
@@ -281,12 +451,19 @@ def main():
                         help="restore values, ignore pickled ones")
 
     parser.add_argument('--no-vhash', action='store_true',
-                        help="vhash showd as 0, save time for decompress")
+                        help="vhash showd as 0, only read headers and keys, "
+                        "values are not read nor crc checked")
     parser.add_argument('--no-header', action='store_true',
                         help="do not print header and tailer")
     parser.add_argument('--start-pos', default=0, type=int)
     parser.add_argument('--stop-pos', default=0, type=int)
     parser.add_argument('--stop-bad', action='store_true')
+    parser.add_argument('--mmap', action='store_true',
+                        help="read through a mmap, faster, only for files "
+                        "on a healthy disk: a bad sector kills the dump")
+    parser.add_argument('--resync', action='store_true',
+                        help="after a bad record or read error, go on from "
+                        "the next record with a valid crc")
     parser.add_argument('datafile')
     args = parser.parse_args()
 
@@ -297,7 +474,11 @@ def main():
 
     signal.signal(signal.SIGPIPE, signal.SIG_DFL)
     decompress_value = args.show_value or (not args.no_vhash)
-    with DataFile(args.datafile, True, decompress_value, args.stop_bad) as f:
+    skip_value = not decompress_value
+    with DataFile(args.datafile, True, decompress_value, args.stop_bad,
+                  use_mmap=args.mmap and not skip_value,
+                  skip_value=skip_value,
+                  resync=args.resync) as f:
         f.seek(args.start_pos)
         i = 0
         for (pos, rec) in f:
@@ -306,6 +487,8 @@ def main():
                 continue
             (key, vsz, value, flag, tstamp, ver) = rec
             vhash = 0
+            if value is None:
+                value = ""
             ksz = len(key)
             rsize = get_record_size(ksz, vsz)
             time_str = get_rec_time_str(tstamp)
@@ -324,6 +507,8 @@ def main():
                 break
             i += 1
         print "num_bad", f.num_bad
+        for start, end in f.skipped:
+            print "skipped %x-%x" % (start, end)
 
     if not args.no_header:
         print header
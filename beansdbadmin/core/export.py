@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''export the live records of a bucket to a compact stream, and import
+such a stream into new data files, so a migration ships only live bytes.
+
+the bucket should not be written during export, and the newest chunk,
+which has no hint yet, is indexed by scanning its data file. the khash
+index is kept next to the bucket unless given another path, e.g. when
+the bucket is on a read-only or salvage mount. data files are read with
+plain reads, not a mmap, so a bad sector is a bad record, not a SIGBUS.
+
+stream = zlib(magic + items + end)
+    item = (ts, flag, ver, ksz, vsz) + key + value, value as stored
+    end  = an item header with ksz 0
+
+    python -m beansdbadmin.core.export export /var/lib/beansdb/0/a > a.bexp
+    python -m beansdbadmin.core.export export /mnt/dead/0/a --index /tmp/a.kidx
+    python -m beansdbadmin.core.export import /data/beansdb/0/a < a.bexp
+'''
+
+import os
+import sys
+import glob
+import zlib
+import heapq
+import array
+import struct
+import logging
+import itertools
+from collections import defaultdict
+
+from beansdbadmin.core.data import (
+    DataFile, read_record, read_record_key, write_record, get_record_size,
+    R_KEY, R_VSZ, R_VALUE, R_FLAG, R_TS, R_VER)
+from beansdbadmin.core.hash import get_khash64
+from beansdbadmin.core.path import make_basename, parse_basename
+from beansdbadmin.core.khash_index import (
+    get_bucket_index, sort_entries, E_KHASH, E_CHUNK, E_POS, E_VER)
+
+MAGIC = 'BEXP0001'
+ITEM_HEAD_FMT = '<IiiII'
+ITEM_HEAD_SIZE = struct.calcsize(ITEM_HEAD_FMT)
+STREAM_BLOCK_SIZE = 1 << 20
+DATA_FILE_MAX = 4000 << 20  # same as gobeansdb
+
+
+class ExportError(Exception):
+    pass
+
+
+def get_data_chunks(bucket_dir):
+    chunks = dict()
+    for path in glob.glob(os.path.join(bucket_dir, '*.data')):
+        fid, _ = parse_basename(os.path.basename(path))
+        if fid is not None:
+            chunks[fid] = path
+    return chunks
+
+
+def iter_data_entries(data_path, chunk):
+    with DataFile(data_path, stop_on_bad=False, skip_value=True) as f:
+        for pos, rec in f:
+            if rec is None:
+                logging.warning("%s: bad record at %x: %s",
+                                data_path, pos, f.get_last_error())
+                continue
+            yield (get_khash64(rec[R_KEY]), chunk, pos, rec[R_VER], 0)
+
+
+class DataFiles(object):
+    '''the data files of a bucket, opened on demand'''
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.files = dict()
+
+    def get(self, chunk):
+        f = self.files.get(chunk)
+        if f is None:
+            f = open(self.chunks[chunk], 'rb')
+            self.files[chunk] = f
+        return f
+
+    def read_key(self, chunk, pos):
+        f = self.get(chunk)
+        f.seek(pos, 0)
+        rec = read_record_key(f)
+        if rec is None:
+            raise ExportError("no record at %x of chunk %d" % (pos, chunk))
+        return rec[R_KEY]
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = dict()
+
+
+def iter_live_entries(bucket_dir, index_path=None):
+    ''' yield (khash, chunk, pos, ver, vhash) of the newest version of
+        each key if it is not deleted, in khash order, streamed from the
+        on-disk khash index at index_path (default next to the bucket)'''
+    chunks = get_data_chunks(bucket_dir)
+    index = get_bucket_index(bucket_dir, index_path)
+    indexed = set([v[0] for v in index.manifest.values()])
+    extra = sort_entries(
+        itertools.chain(*[iter_data_entries(chunks[c], c)
+                          for c in sorted(set(chunks) - indexed)]),
+        os.path.dirname(index.path))
+
+    entries = (e for e in index.iter_entries() if e[E_CHUNK] in chunks)
+    files = DataFiles(chunks)
+    try:
+        merged = heapq.merge(entries, extra)
+        for _, group in itertools.groupby(merged, key=lambda e: e[E_KHASH]):
+            group = list(group)
+            if len(group) > 1:
+                # the same key rewritten, or keys with the same khash
+                newest = dict()
+                for e in group:
+                    key = files.read_key(e[E_CHUNK], e[E_POS])
+                    old = newest.get(key)
+                    if old is None or e[E_CHUNK:E_POS + 1] > old[E_CHUNK:E_POS + 1]:
+                        newest[key] = e
+                group = newest.values()
+            for e in group:
+                if e[E_VER] > 0:
+                    yield e
+    finally:
+        files.close()
+        index.close()
+
+
+def get_live_positions(bucket_dir, index_path=None):
+    ''' return {chunk: array of pos}, the positions of the newest
+        version of each key, if it is not deleted'''
+    live = defaultdict(lambda: array.array('I'))
+    for e in iter_live_entries(bucket_dir, index_path):
+        live[e[E_CHUNK]].append(e[E_POS])
+    return dict((c, array.array('I', sorted(p))) for c, p in live.items())
+
+
+class StreamWriter(object):
+
+    def __init__(self, f, level=6):
+        self.f = f
+        self.z = zlib.compressobj(level)
+        self.buf = []
+        self.size = 0
+        self.write(MAGIC)
+
+    def write(self, data):
+        self.buf.append(data)
+        self.size += len(data)
+        if self.size >= STREAM_BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.f.write(self.z.compress(''.join(self.buf)))
+            self.buf = []
+            self.size = 0
+
+    def write_item(self, key, value, flag, ts, ver):
+        self.write(struct.pack(ITEM_HEAD_FMT, ts, flag, ver, len(key), len(value)))
+        self.write(key)
+        self.write(value)
+
+    def close(self):
+        self.write(struct.pack(ITEM_HEAD_FMT, 0, 0, 0, 0, 0))
+        self.flush()
+        self.f.write(self.z.flush())
+        self.f.flush()
+
+
+class StreamReader(object):
+
+    def __init__(self, f):
+        self.f = f
+        self.z = zlib.decompressobj()
+        self.buf = ''
+        self.off = 0
+        if self.read(len(MAGIC)) != MAGIC:
+            raise ExportError("not an export stream")
+
+    def read(self, n):
+        while len(self.buf) - self.off < n:
+            data = self.f.read(STREAM_BLOCK_SIZE)
+            if not data:
+                raise ExportError("truncated stream")
+            self.buf = self.buf[self.off:] + self.z.decompress(data)
+            self.off = 0
+        data = self.buf[self.off:self.off + n]
+        self.off += n
+        return data
+
+    def __iter__(self):
+        while True:
+            ts, flag, ver, ksz, vsz = struct.unpack(
+                ITEM_HEAD_FMT, self.read(ITEM_HEAD_SIZE))
+            if ksz == 0:
+                return
+            key = self.read(ksz)
+            value = self.read(vsz)
+            yield key, value, flag, ts, ver
+
+
+def export_bucket(bucket_dir, out, index_path=None):
+    ''' write the live records of bucket_dir to file object out,
+        return stats dict'''
+    live = get_live_positions(bucket_dir, index_path)
+    chunks = get_data_chunks(bucket_dir)
+    w = StreamWriter(out)
+    stats = dict(count=0, bad=0, size=0)
+    for chunk in sorted(live):
+        with open(chunks[chunk], 'rb') as f:
+            for pos in live[chunk]:
+                try:
+                    f.seek(pos, 0)
+                    rec = read_record(f, decompress_value=False)
+                    if rec is None:
+                        raise EOFError("truncated")
+                except Exception as e:
+                    logging.error("%s: bad record at %x: %s",
+                                  chunks[chunk], pos, e)
+                    stats['bad'] += 1
+                    continue
+                w.write_item(rec[R_KEY], rec[R_VALUE], rec[R_FLAG],
+                             rec[R_TS], rec[R_VER])
+                stats['count'] += 1
+                stats['size'] += get_record_size(len(rec[R_KEY]), rec[R_VSZ])
+    w.close()
+    return stats
+
+
+def import_bucket(inp, bucket_dir, max_file_size=DATA_FILE_MAX):
+    ''' write the records of an export stream to new data files in
+        bucket_dir, after the existing chunks, return stats dict;
+        hints are left to be rebuilt'''
+    chunks = get_data_chunks(bucket_dir)
+    chunk = max(chunks) + 1 if chunks else 0
+    stats = dict(count=0, files=0, size=0)
+    f = None
+    size = 0
+    try:
+        for key, value, flag, ts, ver in StreamReader(inp):
+            rsize = get_record_size(len(key), len(value))
+            if f is None or size + rsize > max_file_size:
+                if f is not None:
+                    f.close()
+                    chunk += 1
+                name = make_basename(chunk, 'data')
+                if name is None or os.path.exists(os.path.join(bucket_dir, name)):
+                    raise ExportError("can not create chunk %d" % chunk)
+                path = os.path.join(bucket_dir, name)
+                f = open(path, 'wb')
+                stats['files'] += 1
+                size = 0
+            size += write_record(f, key, value, flag, ts, ver)
+            stats['count'] += 1
+            stats['size'] += rsize
+    finally:
+        if f is not None:
+            f.close()
+    return stats
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="export live records of a bucket, or import them")
+    parser.add_argument('cmd', choices=['export', 'import'])
+    parser.add_argument('bucket_dir')
+    parser.add_argument('-f', '--file', help="default stdout/stdin")
+    parser.add_argument('--index', help="khash index path for export, "
+                        "default <bucket_dir>.kidx")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.cmd == 'export':
+        out = open(args.file, 'wb') if args.file else sys.stdout
+        with out:
+            stats = export_bucket(args.bucket_dir, out, args.index)
+    else:
+        inp = open(args.file, 'rb') if args.file else sys.stdin
+        with inp:
+            stats = import_bucket(inp, args.bucket_dir)
+    logging.info("%s %s: %s", args.cmd, args.bucket_dir, stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,13 +8,26 @@ compare hint and data
 import os
 import glob
 import re
-from beansdbadmin.core.hash import get_khash, get_vhash
+import json
+import time
+import collections
+import multiprocessing
+from beansdbadmin.core.hash import get_khash, get_khash64, get_vhash
 from beansdbadmin.core.path import (change_path_dbhome,
                                     get_all_files_index,
+                                    get_mount_point,
+                                    home_to_homes,
                                     check_zero_len,
+                                    parse_path,
+                                    make_path,
                                     MAX_CHUNK_ID)
-from beansdbadmin.core.hint import HintFile, get_keyinfo_from_hint
+from beansdbadmin.core.hint import (HintFile, get_keyinfo_from_hint,
+                                    get_new_hint_name)
 from beansdbadmin.core.data import DataFile, R_KEY
+from beansdbadmin.core.khash_index import (get_bucket_index,
+                                           E_CHUNK, E_POS, E_VER, E_VHASH)
+
+CHECK_TIMEOUT = 3600  # seconds to wait for the next result of a disk
 
 
 def eq_(a, b, msg=None):
@@ -66,6 +79,40 @@ def locate_key_with_hint(db_homes, db_depth, key, ver_=None):
     return False
 
 
+def locate_key_with_index(db_homes, db_depth, key, ver_=None):
+    """ like locate_key_with_hint, but look up the khash index of the
+        bucket, which is built or updated from its hints first
+    """
+    if isinstance(db_homes, (list, tuple)):
+        db_home = db_homes[0]
+    else:
+        db_home = db_homes
+    key_hash = get_khash(key)
+    if db_depth == 1:
+        sector_path = "%x" % ((key_hash >> 28) & 0xf)
+    elif db_depth == 2:
+        sector_path = "%x/%x" % ((key_hash >> 28) & 0xf,
+                                 (key_hash >> 24) & 0xf)
+    else:
+        raise NotImplementedError()
+    with get_bucket_index(os.path.join(db_home, sector_path)) as index:
+        entries = index.lookup(get_khash64(key))
+    for e in reversed(entries):
+        ver = e[E_VER]
+        if ver_ is not None and ver != ver_:
+            continue
+        data_file = os.path.join(db_home, sector_path,
+                                 "%03d.data" % e[E_CHUNK])
+        try:
+            if check_data_with_key(data_file, key, ver_=ver,
+                                   hash_=e[E_VHASH] if ver > 0 else None,
+                                   pos=e[E_POS]):
+                return True
+        except AssertionError:
+            continue  # khash collision
+    return False
+
+
 def locate_key_iterate(db_homes, db_depth, key, ver_=None):
     """ assume disk0 already have link,
     Returns
@@ -97,12 +144,16 @@ def locate_key_iterate(db_homes, db_depth, key, ver_=None):
 
 def check_data_with_key(file_path, key, ver_=None, hash_=None, pos=None):
     """ if pos is None, iterate data file to match key and ver_,
-        otherwise seek to pos and check key and ver_ and hash_
+        bad records are skipped, otherwise seek to pos and check key
+        and ver_ and hash_
     """
-    with DataFile(file_path, True) as f:
+    scan = pos is None
+    with DataFile(file_path, True, stop_on_bad=not scan, resync=scan) as f:
         if pos is not None:
             f.seek(pos)
         for (_, rec) in f:
+            if rec is None:
+                continue
             (key2, _, value, _, _, ver) = rec
 
             if pos is not None:
@@ -123,9 +174,36 @@ def check_data_with_key(file_path, key, ver_=None, hash_=None, pos=None):
     return False
 
 
+class HintKeyList(object):
+    '''build_key_list_from_hint result on HintColumns, sorted by pos
+    in numpy, keys are only sliced out when indexed'''
+
+    def __init__(self, columns):
+        self.columns = columns
+        items = columns.items
+        pos = (items['pos'] & 0xffffff00).astype('i8')
+        order = pos.argsort(kind='mergesort')
+        self.pos = pos[order].tolist()
+        self.vers = items['ver'][order].tolist()
+        self.vhashes = items['vhash'][order].tolist()
+        self.koffs = columns.koffs[order].tolist()
+        self.kszs = items['ksz'][order].tolist()
+
+    def __len__(self):
+        return len(self.pos)
+
+    def __getitem__(self, j):
+        off = self.koffs[j]
+        return (self.pos[j], self.columns.hint_data[off:off + self.kszs[j]],
+                self.vers[j], self.vhashes[j])
+
+
 def build_key_list_from_hint(file_path):
-    key_list = list()
     hf = HintFile(file_path, None, check_khash=False)
+    columns = hf.columns()
+    if columns is not None:
+        return HintKeyList(columns)
+    key_list = list()
     for key, rmeta, _ in hf:
         _, pos, ver, vhash = rmeta
         key_list.append((pos & 0xffffff00, key, ver, vhash))
@@ -197,6 +275,154 @@ def check_data_hint_integrity(db_homes, db_depth, bucket=None,
                     os.unlink(link_path)
 
 
+def _find_new_hint(data_file, fid):
+    ''' the .idx.s hint next to data_file or to its link target, or None '''
+    name = get_new_hint_name(fid)
+    for dir_ in (os.path.dirname(data_file),
+                 os.path.dirname(os.path.realpath(data_file))):
+        path = os.path.join(dir_, name)
+        if os.path.exists(path):
+            return path
+
+
+def _get_integrity_tasks(db_homes, db_depth, bucket=None, begin_number=None):
+    '''return ([(bucket, fid, data_file, hint_file)] to check,
+    [(bucket, fid, data_file)] without a hint of either format),
+    a .idx.s hint is checked in preference to a .hint.qlz one'''
+    index, _ = get_all_files_index(db_homes, db_depth)
+    tasks = []
+    no_hint = []
+    for bucket_, num_ext_dict in sorted(index.items()):
+        if bucket is not None and bucket_[:len(bucket)] != bucket:
+            continue
+        for (fid, ext), files in num_ext_dict.items():
+            if ext != 'data':
+                continue
+            if begin_number is not None and fid < begin_number:
+                continue
+            hint_file = _find_new_hint(files[0], fid)
+            if hint_file is None:
+                old_hints = num_ext_dict.get((fid, 'hint.qlz'))
+                if old_hints:
+                    hint_file = old_hints[0]
+            if hint_file is not None:
+                tasks.append((bucket_, fid, files[0], hint_file))
+            else:
+                no_hint.append((bucket_, fid, files[0]))
+    tasks.sort()
+    no_hint.sort()
+    return tasks, no_hint
+
+
+def _check_chunk_integrity(task):
+    bucket, fid, data_file, hint_file = task
+    result = {'bucket': "".join("%x" % x for x in bucket),
+              'chunk': fid,
+              'data': data_file,
+              'hint': hint_file,
+              'ok': True,
+              'err_type': None,
+              'err': None}
+    t = time.time()
+    try:
+        check_data_with_hint(data_file, hint_file)
+    except Exception as e:
+        result['ok'] = False
+        result['err_type'] = e.__class__.__name__
+        result['err'] = str(e)
+    result['time'] = time.time() - t
+    return result
+
+
+def _get_pool_results(it, num, timeout):
+    ''' yield num results of an imap_unordered iterator as they are done,
+        stop if none is done in timeout seconds, e.g. when a worker died '''
+    for _ in xrange(num):
+        try:
+            yield it.next(timeout)
+        except multiprocessing.TimeoutError:
+            return
+
+
+def check_data_hint_integrity_parallel(db_homes, db_depth, bucket=None,
+                                       begin_number=None, fix=False,
+                                       procs_per_disk=1, report_path=None,
+                                       timeout=CHECK_TIMEOUT):
+    '''check_data_hint_integrity over a process pool per disk,
+    so that no more than procs_per_disk chunks are read from a disk at once.
+
+    return a report dict, also dumped as json to report_path if given;
+    with fix, hints of HintError chunks are removed as in the serial one.
+    if a disk gives no result in timeout seconds, its pool is terminated
+    and its unchecked chunks are reported as TimeoutError.
+    '''
+    tasks, no_hint = _get_integrity_tasks(db_homes, db_depth, bucket,
+                                          begin_number)
+    disk_tasks = collections.defaultdict(list)
+    for task in tasks:
+        disk_tasks[get_mount_point(task[2])].append(task)
+
+    start = time.time()
+    pools = []
+    for disk, tasks_ in disk_tasks.items():
+        pool = multiprocessing.Pool(min(procs_per_disk, len(tasks_)))
+        it = pool.imap_unordered(_check_chunk_integrity, tasks_)
+        pools.append((disk, pool, tasks_, it))
+    results = []
+    for disk, pool, tasks_, it in pools:
+        done = set()
+        for r in _get_pool_results(it, len(tasks_), timeout):
+            r['disk'] = disk
+            results.append(r)
+            done.add(r['data'])
+        lost = [t for t in tasks_ if t[2] not in done]
+        for bucket_, fid, data_file, hint_file in lost:
+            results.append({'bucket': "".join("%x" % x for x in bucket_),
+                            'chunk': fid, 'data': data_file,
+                            'hint': hint_file, 'disk': disk, 'ok': False,
+                            'err_type': 'TimeoutError',
+                            'err': "no result in %ds" % timeout,
+                            'time': None})
+        if lost:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+    results.sort(key=lambda r: (r['bucket'], r['chunk']))
+
+    errors = [r for r in results if not r['ok']]
+    if fix:
+        for r in errors:
+            if r['err_type'] == HintError.__name__:
+                _remove_hint(r['hint'], db_homes, db_depth)
+                r['removed'] = True
+    report = {'db_homes': list(home_to_homes(db_homes)),
+              'db_depth': db_depth,
+              'time': time.time() - start,
+              'num_checked': len(results),
+              'num_error': len(errors),
+              'num_no_hint': len(no_hint),
+              'no_hint': [{'bucket': "".join("%x" % x for x in b),
+                           'chunk': fid, 'data': data_file}
+                          for b, fid, data_file in no_hint],
+              'errors': errors,
+              'results': results}
+    if report_path is not None:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+def _remove_hint(hint_file, db_homes, db_depth):
+    os.remove(hint_file)
+    db_home = home_to_homes(db_homes)[0]
+    # parse the dir, parse_basename does not know .idx.s
+    _, buckets, _, _ = parse_path(os.path.dirname(hint_file), depth=db_depth)
+    link_path = make_path(db_home, buckets, os.path.basename(hint_file))
+    if os.path.islink(link_path):
+        os.unlink(link_path)
+
+
 def check_bucket_data(bucket_files, bucket, readonly=True):
     ok = True
     holes = []
@@ -270,7 +496,8 @@ def check_data_first_key(file_path, bucket):
     """ if ok , return first_key """
     assert isinstance(bucket, tuple)
     assert isinstance(bucket[0], int)
-    with DataFile(file_path, check_crc=False, decompress_value=False) as f:
+    with DataFile(file_path, check_crc=False, decompress_value=False,
+                  skip_value=True) as f:
         for (_, rec) in f:
             key = rec[R_KEY]
             _hash = get_khash(key)
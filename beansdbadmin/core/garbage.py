@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''estimate the garbage of each chunk of a bucket offline, from its hints:
+a record is live if it is the newest version of its key (by chunk, pos)
+and not deleted, everything else would be reclaimed by a gc.
+
+the size of a live record is read from its own header in the data file
+(ksz and vsz, padded to 256 bytes), as a hint has only the newest record
+of each key, and superseded copies of a key between two live records
+are garbage too. with sample > 1, only keys with khash % sample == 0 are
+looked at, and their live bytes are scaled by sample.
+'''
+
+import os
+import heapq
+import array
+import struct
+import logging
+import itertools
+from collections import defaultdict
+
+from beansdbadmin.core.data import (
+    REC_HEAD_SIZE, MAX_KEY_LEN, MAX_VALUE_SIZE, get_record_size)
+from beansdbadmin.core.khash_index import (
+    get_bucket_index, sort_entries, E_KHASH, E_CHUNK, E_POS, E_VER)
+from beansdbadmin.core.export import get_data_chunks, iter_data_entries
+
+GC_MIN_RECLAIM = (1 << 30)
+
+
+class ChunkGarbage(object):
+
+    def __init__(self, chunk, size, live, indexed=True):
+        self.chunk = chunk
+        self.size = size
+        self.live = live
+        self.indexed = indexed
+
+    @property
+    def garbage(self):
+        return self.size - self.live
+
+    def to_list(self):
+        return [self.chunk, self.size, self.live, self.indexed]
+
+    def __repr__(self):
+        return "(%d %d/%d)" % (self.chunk, self.live, self.size)
+
+
+def get_live_sizes(data_path, positions):
+    ''' sum the sizes of the records at positions, from their headers '''
+    live = 0
+    with open(data_path, 'rb') as f:
+        for pos in sorted(positions):
+            try:
+                f.seek(pos, 0)
+                header = f.read(REC_HEAD_SIZE)
+            except (IOError, OSError) as e:
+                logging.warning("%s: read header at %x: %s", data_path, pos, e)
+                continue
+            if len(header) < REC_HEAD_SIZE:
+                continue
+            ksz, vsz = struct.unpack_from("II", header, 16)
+            if 0 < ksz <= MAX_KEY_LEN and 0 <= vsz <= MAX_VALUE_SIZE:
+                live += get_record_size(ksz, vsz)
+    return live
+
+
+def estimate_bucket(bucket_dir, sample=1):
+    ''' return [ChunkGarbage] sorted by chunk '''
+    chunks = get_data_chunks(bucket_dir)
+    index = get_bucket_index(bucket_dir)
+    indexed = set([v[0] for v in index.manifest.values()])
+    extra = sort_entries(
+        itertools.chain(*[iter_data_entries(chunks[c], c)
+                          for c in sorted(set(chunks) - indexed)]),
+        os.path.dirname(index.path))
+
+    positions = defaultdict(lambda: array.array('I'))  # of live records
+    try:
+        entries = (e for e in index.iter_entries() if e[E_CHUNK] in chunks)
+        merged = heapq.merge(entries, extra)
+        for khash, group in itertools.groupby(merged, key=lambda e: e[E_KHASH]):
+            if sample > 1 and khash % sample:
+                continue
+            newest = max(group, key=lambda e: (e[E_CHUNK], e[E_POS]))
+            if newest[E_VER] > 0:
+                positions[newest[E_CHUNK]].append(newest[E_POS])
+    finally:
+        index.close()
+
+    res = []
+    for chunk in sorted(chunks):
+        size = os.path.getsize(chunks[chunk])
+        live = 0
+        if chunk in positions:
+            live = get_live_sizes(chunks[chunk], positions[chunk])
+            live = min(size, live * sample)
+        res.append(ChunkGarbage(chunk, size, live, chunk in indexed))
+    logging.debug("garbage of %s: %s", bucket_dir, res)
+    return res
+
+
+def choose_gc_range(chunks, min_reclaim=GC_MIN_RECLAIM):
+    ''' return (start, end, reclaim, io) of the chunk range with the most
+        bytes reclaimed per byte read and rewritten by a gc, among those
+        reclaiming at least min_reclaim (or the most, if none does),
+        None if nothing to reclaim;
+        only the leading chunks with hints are candidates, the newest
+        chunk is still being written'''
+    cands = []
+    for c in chunks:
+        if not c.indexed:
+            break
+        cands.append(c)
+    best = None
+    best_key = None
+    for i in range(len(cands)):
+        reclaim = io = 0
+        for j in range(i, len(cands)):
+            reclaim += cands[j].garbage
+            io += cands[j].size + cands[j].live
+            if reclaim <= 0:
+                continue
+            if reclaim >= min_reclaim:
+                key = (1, float(reclaim) / io)
+            else:
+                key = (0, reclaim)
+            if best_key is None or key > best_key:
+                best_key = key
+                best = (cands[i].chunk, cands[j].chunk, reclaim, io)
+    return best
+
+
+def estimate_gc(bucket_dir, sample=1, min_reclaim=GC_MIN_RECLAIM):
+    chunks = estimate_bucket(bucket_dir, sample)
+    return {
+        'chunks': [c.to_list() for c in chunks],
+        'best': choose_gc_range(chunks, min_reclaim),
+    }
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="estimate reclaimable bytes of chunks of a bucket")
+    parser.add_argument('--sample', type=int, default=1,
+                        help="only look at 1/sample of the keys")
+    parser.add_argument('bucket_dir')
+    args = parser.parse_args()
+
+    res = estimate_gc(args.bucket_dir, args.sample)
+    print "chunk size live garbage"
+    for chunk, size, live, _ in res['chunks']:
+        print "%03d %d %d %d" % (chunk, size, live, size - live)
+    print "best (start, end, reclaim, io):", res['best']
+
+
+if __name__ == "__main__":
+    main()
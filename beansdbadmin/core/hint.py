@@ -5,28 +5,82 @@
     = (key, (khash, data_pos, ver, vhash), (i, off_s))
 '''
 
+import os
+import array
 import struct
 import sys
+import bisect
 import signal
 import quicklz
 from beansdbadmin.core.hash import get_khash64
 
+try:
+    import numpy
+    from numpy.lib.stride_tricks import as_strided
+except ImportError:
+    numpy = None
+
 ITEM_META_SIZE_OLD = 10
 ITEM_META_SIZE_NEW = 23
 FILE_HEADER_SIZE_NEW = 16
+INDEX_ITEM_SIZE = 16
+INDEX_INTERVAL = 4096  # bytes of items between index items, when writing
+HINT_READ_BLOCK = 1 << 16
 
 
 class HintIndex(object):
-    '''key: (version, pos)'''
+    '''the index section of a new hint file,
+    items are sorted by khash, and every some items are indexed by
+    (khash, file offset), 16 bytes each, from index_off_s to the end.'''
 
     def __init__(self):
-        pass
+        self.index_off_s = 0
+        self.count = 0
+        self.datasize = 0
+        self.khashes = []
+        self.offsets = []
 
     def load(self, path):
-        pass
+        with open(path, 'r') as f:
+            header = f.read(FILE_HEADER_SIZE_NEW)
+            self.index_off_s, self.count, self.datasize = \
+                parse_new_hint_header(header)
+            index_data = ''
+            if self.index_off_s > 0:
+                f.seek(self.index_off_s)
+                index_data = f.read()
+        self._load_index(index_data)
+        return self
 
     def loads(self, hint_data):
-        pass
+        self.index_off_s, self.count, self.datasize = \
+            parse_new_hint_header(hint_data)
+        index_data = ''
+        if self.index_off_s > 0:
+            index_data = hint_data[self.index_off_s:]
+        self._load_index(index_data)
+        return self
+
+    def _load_index(self, index_data):
+        n = len(index_data) / INDEX_ITEM_SIZE
+        items = [struct.unpack_from('QQ', index_data, i * INDEX_ITEM_SIZE)
+                 for i in xrange(n)]
+        last = FILE_HEADER_SIZE_NEW
+        for _, off in items:
+            if not last <= off <= self.index_off_s:
+                items = []  # not a index we know, scan the whole body
+                break
+            last = off
+        self.khashes = [x[0] for x in items]
+        self.offsets = [x[1] for x in items]
+
+    def get_range(self, khash):
+        '''return [start, stop) file offsets of items may have khash'''
+        i = bisect.bisect_left(self.khashes, khash) - 1
+        j = bisect.bisect_right(self.khashes, khash)
+        start = self.offsets[i] if i >= 0 else FILE_HEADER_SIZE_NEW
+        stop = self.offsets[j] if j < len(self.offsets) else None
+        return start, stop
 
 
 def parse_old_hint(hint_data):
@@ -68,6 +122,82 @@ def parse_new_hint_body(hint_data, check_khash=False):
         off_s += ksz
 
 
+# same layout as 'QiIiHB'
+HINT_ITEM_DTYPE = [('khash', '<u8'), ('chunk', '<i4'), ('pos', '<u4'),
+                   ('ver', '<i4'), ('vhash', '<u2'), ('ksz', 'u1')]
+
+
+class HintColumns(object):
+    '''a new hint body decoded into columns, need numpy
+
+    items is a structured array of HINT_ITEM_DTYPE, koffs the offsets of
+    keys in hint_data, keys are only sliced out by key(i) or keys(rows).
+
+    items are variable sized, so finding them is still one python loop,
+    over their ksz bytes only; the headers are then copied out at once
+    through a sliding window view of hint_data, without an index matrix.
+    '''
+
+    def __init__(self, hint_data):
+        self.hint_data = hint_data
+        # pass 1: walk ksz to find where the items are
+        ksz_at = bytearray(hint_data)
+        stop = len(hint_data) - ITEM_META_SIZE_NEW
+        offs = array.array('l')
+        off = 0
+        while off <= stop:
+            offs.append(off)
+            off += ITEM_META_SIZE_NEW + ksz_at[off + ITEM_META_SIZE_NEW - 1]
+        del ksz_at
+        offs = numpy.frombuffer(offs, dtype=numpy.int_)  # array 'l'
+
+        # pass 2: gather the item headers, rows of a window over hint_data
+        buf = numpy.frombuffer(hint_data, dtype=numpy.uint8)
+        if len(buf) >= ITEM_META_SIZE_NEW:
+            window = as_strided(buf, shape=(len(buf) - ITEM_META_SIZE_NEW + 1,
+                                            ITEM_META_SIZE_NEW),
+                                strides=(1, 1))
+            rows = window[offs]
+        else:
+            rows = numpy.zeros((0, ITEM_META_SIZE_NEW), dtype=numpy.uint8)
+        self.items = rows.view(numpy.dtype(HINT_ITEM_DTYPE)).ravel()
+        self.koffs = offs + ITEM_META_SIZE_NEW
+
+    def __len__(self):
+        return len(self.items)
+
+    def key(self, i):
+        off = int(self.koffs[i])
+        return self.hint_data[off:off + int(self.items['ksz'][i])]
+
+    def keys(self, rows=None):
+        ''' keys of rows (an index array, default all) '''
+        koffs, kszs = self.koffs, self.items['ksz']
+        if rows is not None:
+            koffs, kszs = koffs[rows], kszs[rows]
+        data = self.hint_data
+        return [data[off:off + ksz]
+                for off, ksz in zip(koffs.tolist(), kszs.tolist())]
+
+    def colliding(self):
+        ''' indexes of the rows whose khash is in more than one row '''
+        khashes = self.items['khash']
+        order = khashes.argsort(kind='mergesort')
+        sorted_ = khashes[order]
+        dup = numpy.zeros(len(sorted_), dtype=bool)
+        same = sorted_[1:] == sorted_[:-1]
+        dup[1:] |= same
+        dup[:-1] |= same
+        return numpy.sort(order[dup])
+
+
+def parse_new_hint_columns(hint_data):
+    '''columnar parse_new_hint_body, None if numpy is not installed'''
+    if numpy is None:
+        return None
+    return HintColumns(hint_data)
+
+
 def parse_new_hint_header(hint_data):
     return struct.unpack('QII', hint_data[:FILE_HEADER_SIZE_NEW])
 
@@ -81,6 +211,33 @@ def parse_new_hint(hint_data, check_khash=False):
     )
 
 
+def iter_new_hint_items(path, block_size=HINT_READ_BLOCK):
+    '''yield (key, (khash, pos, ver, vhash)) of a new hint file, in file
+    order, read block_size bytes at a time instead of as a whole'''
+    with open(path, 'rb') as f:
+        index_off_s, _, _ = parse_new_hint_header(f.read(FILE_HEADER_SIZE_NEW))
+        if index_off_s > 0:
+            remain = index_off_s - FILE_HEADER_SIZE_NEW
+        else:
+            remain = os.fstat(f.fileno()).st_size - FILE_HEADER_SIZE_NEW
+        buf = ''
+        i = 0
+        while True:
+            # an item is at most ITEM_META_SIZE_NEW + 255 bytes
+            if len(buf) - i < ITEM_META_SIZE_NEW + 255 and remain > 0:
+                data = f.read(min(block_size, remain))
+                remain = remain - len(data) if data else 0
+                buf = buf[i:] + data
+                i = 0
+            if len(buf) - i < ITEM_META_SIZE_NEW:
+                return
+            khash, _, pos, ver, vhash, ksz = struct.unpack_from('QiIiHB', buf, i)
+            i += ITEM_META_SIZE_NEW
+            key = buf[i:i + ksz]
+            i += ksz
+            yield key, (khash, pos, ver, vhash)
+
+
 class HintFile(object):
     def __init__(self, path, is_new=None, stop_on_bad=False, check_khash=False):
         # print check_khash
@@ -101,6 +258,9 @@ class HintFile(object):
             else:
                 raise Exception("%s has unexpected suffix" % path)
 
+        self.g = None
+
+    def load(self):
         with open(self.path, 'r') as f:
             hint_data = f.read()
         if self.is_new:
@@ -109,7 +269,7 @@ class HintFile(object):
             hint_len = len(hint_data) if index_off_s == 0 else index_off_s
             self.g = parse_new_hint_body(
                 hint_data[FILE_HEADER_SIZE_NEW:hint_len],
-                check_khash
+                self.check_khash
             )
         else:
             hint_data = quicklz.decompress(hint_data)
@@ -119,14 +279,111 @@ class HintFile(object):
         return self
 
     def next(self):
+        if self.g is None:
+            self.load()
         return self.g.next()
 
+    def columns(self):
+        '''return HintColumns of a new hint,
+        None if it is a old one or numpy is not installed'''
+        if not self.is_new or numpy is None:
+            return None
+        with open(self.path, 'r') as f:
+            hint_data = f.read()
+        index_off_s, _, _ = parse_new_hint_header(hint_data)
+        hint_len = len(hint_data) if index_off_s == 0 else index_off_s
+        return HintColumns(hint_data[FILE_HEADER_SIZE_NEW:hint_len])
+
+    def lookup(self, khash):
+        '''return items of khash, for new hints, only the region given by
+        the index section is read and decoded, i of items counts from it'''
+        if not self.is_new:
+            return [it for it in HintFile(self.path, False)
+                    if get_khash64(it[0]) == khash]
+
+        index = HintIndex().load(self.path)
+        start, stop = index.get_range(khash)
+        if stop is None:
+            stop = index.index_off_s
+        with open(self.path, 'r') as f:
+            f.seek(start)
+            if stop > 0:
+                region = f.read(stop - start)
+            else:
+                region = f.read()
+        items = []
+        base = start - FILE_HEADER_SIZE_NEW
+        for key, meta, (i, off_s) in parse_new_hint_body(region):
+            if meta[0] > khash:
+                break  # sorted by khash
+            if meta[0] == khash:
+                items.append((key, meta, (i, base + off_s)))
+        return items
+
+
+def get_new_hint_name(chunk_id, split=0):
+    return '%03d.%03d.idx.s' % (chunk_id, split)
+
+
+class NewHintWriter(object):
+    '''write a new hint file from items added in khash order,
+    to path.tmp, renamed to path on close'''
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp = path + '.tmp'
+        self.f = open(self.tmp, 'wb')
+        self.f.write('\0' * FILE_HEADER_SIZE_NEW)
+        self.off = FILE_HEADER_SIZE_NEW
+        self.count = 0
+        self.index = []
+        self.last_indexed = None
+
+    def add(self, key, khash, chunk_id, pos, ver, vhash):
+        if self.last_indexed is None or \
+                self.off - self.last_indexed >= INDEX_INTERVAL:
+            self.index.append((khash, self.off))
+            self.last_indexed = self.off
+        self.f.write(struct.pack('QiIiHB', khash, chunk_id, pos, ver, vhash,
+                                 len(key)))
+        self.f.write(key)
+        self.off += ITEM_META_SIZE_NEW + len(key)
+        self.count += 1
+
+    def close(self, datasize):
+        '''datasize is the size of the data file, return the number of items'''
+        for khash, item_off in self.index:
+            self.f.write(struct.pack('QQ', khash, item_off))
+        self.f.seek(0)
+        self.f.write(struct.pack('QII', self.off, self.count, datasize))
+        self.f.close()
+        os.rename(self.tmp, self.path)
+        return self.count
+
+    def abort(self):
+        self.f.close()
+        os.remove(self.tmp)
+
+
+def write_new_hint(path, items, datasize):
+    '''write a new hint file of items [(key, khash, chunk_id, pos, ver, vhash)],
+    sorted by khash here, with an index item every INDEX_INTERVAL bytes,
+    datasize is the size of the data file; return the number of items'''
+    w = NewHintWriter(path)
+    try:
+        for it in sorted(items, key=lambda it: (it[1], it[3])):
+            w.add(*it)
+    except Exception:
+        w.abort()
+        raise
+    return w.close(datasize)
+
 
 def get_keyinfo_from_hint(file_path, key):
     '''return whethor key is in file'''
     hf = HintFile(file_path, check_khash=False)
 
-    for it in hf:
+    for it in hf.lookup(get_khash64(key)):
         if it[0] == key:
             _, pos, ver, vhash = it[1]
             return pos & 0xffffff00, ver, vhash
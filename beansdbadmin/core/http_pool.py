@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''keep-alive http connections shared by the whole process,
+with timeouts and a limit of concurrent requests per host.
+
+    content = get_url('http://host:7903/du')
+    contents = get_urls([url1, url2, ...])  # concurrently
+'''
+
+import socket
+import httplib
+import logging
+import threading
+import urlparse
+from multiprocessing.dummy import Pool as ThreadPool
+
+logger = logging.getLogger(__name__)
+
+HTTP_TIMEOUT = 10  # seconds, for connect and each read
+MAX_CONNS_PER_HOST = 4
+HTTP_CONCURRENCY = 16
+
+
+def is_empty_status(e):
+    ''' whether BadStatusLine e is for a connection closed with no status
+        line, its message differs between python versions'''
+    return not e.line or e.line.startswith("No status line received")
+
+
+class HostPool(object):
+    '''idle connections to one host:port'''
+
+    def __init__(self, host, port, timeout=HTTP_TIMEOUT,
+                 max_conns=MAX_CONNS_PER_HOST):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sem = threading.BoundedSemaphore(max_conns)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def __repr__(self):
+        return "%s:%d" % (self.host, self.port)
+
+    def get_conn(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        conn = httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout)
+        return conn, False
+
+    def put_conn(self, conn):
+        with self.lock:
+            self.idle.append(conn)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def _request(self, conn, path):
+        ''' return (content, exception, retriable), retriable if it failed
+            while sending, or the connection was closed with no response'''
+        try:
+            conn.request('GET', path)
+        except (httplib.HTTPException, socket.error) as e:
+            return None, e, True
+        try:
+            resp = conn.getresponse()
+        except httplib.BadStatusLine as e:
+            # closed without a byte of response, the usual stale idle conn
+            return None, e, is_empty_status(e)
+        except (httplib.HTTPException, socket.error) as e:
+            return None, e, False
+        try:
+            content = resp.read()
+        except (httplib.HTTPException, socket.error) as e:
+            return None, e, False
+        if resp.will_close:
+            conn.close()
+        else:
+            self.put_conn(conn)
+        return content, None, False
+
+    def request(self, path, retry=True):
+        ''' with retry, a request on a reused connection is sent again on a
+            new one, only if it failed while sending or the connection was
+            closed before any response; use retry=False for requests that
+            must not be sent twice'''
+        with self.sem:
+            conn, reused = self.get_conn()
+            content, e, retriable = self._request(conn, path)
+            if e is None:
+                return content
+            conn.close()
+            if not (retry and reused and retriable) or \
+                    isinstance(e, socket.timeout):
+                raise e
+            logger.debug("retry %s%s on a new connection", self, path)
+            conn = httplib.HTTPConnection(self.host, self.port,
+                                          timeout=self.timeout)
+            content, e, _ = self._request(conn, path)
+            if e is not None:
+                conn.close()
+                raise e
+            return content
+
+
+class HttpPool(object):
+
+    def __init__(self, timeout=HTTP_TIMEOUT, max_conns=MAX_CONNS_PER_HOST,
+                 concurrency=HTTP_CONCURRENCY):
+        self.timeout = timeout
+        self.max_conns = max_conns
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.hosts = dict()
+
+    def get_host(self, host, port):
+        with self.lock:
+            hp = self.hosts.get((host, port))
+            if hp is None:
+                hp = HostPool(host, port, self.timeout, self.max_conns)
+                self.hosts[(host, port)] = hp
+            return hp
+
+    def get(self, url, retry=True):
+        u = urlparse.urlsplit(url)
+        if u.scheme != 'http':
+            raise ValueError("unsupported url %s" % url)
+        path = u.path or '/'
+        if u.query:
+            path += '?' + u.query
+        return self.get_host(u.hostname, u.port or 80).request(path, retry)
+
+    def _get_or_error(self, url):
+        try:
+            return self.get(url)
+        except Exception as e:
+            logger.warning("get %s failed: %s", url, e)
+            return e
+
+    def get_many(self, urls):
+        ''' return contents of urls in order, fetched concurrently,
+            a failed one is its exception instead'''
+        if len(urls) <= 1:
+            return [self._get_or_error(url) for url in urls]
+        pool = ThreadPool(min(len(urls), self.concurrency))
+        try:
+            return pool.map(self._get_or_error, urls)
+        finally:
+            pool.close()
+            pool.join()
+
+    def close(self):
+        with self.lock:
+            hosts, self.hosts = self.hosts, dict()
+        for hp in hosts.values():
+            hp.close()
+
+
+default_pool = HttpPool()
+
+
+def get_url(url, retry=True):
+    return default_pool.get(url, retry)
+
+
+def get_urls(urls):
+    return default_pool.get_many(urls)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''a persistent khash64 -> (chunk, pos, ver, vhash) index of a bucket,
+built from its hint files and stored next to the bucket dir:
+
+    /var/lib/beansdb/0/a/     -> /var/lib/beansdb/0/a.kidx
+
+file = header + manifest + entries
+    header   = (magic, manifest_len, count)
+    manifest = json {hint basename: (chunk, size, mtime)} already indexed
+    entries  = count * (khash, chunk, pos, ver, vhash), sorted by khash
+
+memory is bounded while (re)building: .idx.s hints are already sorted by
+khash and are merged as streams, entries of old hints (and of chunks
+without hints, for callers) are sorted in runs spilled to temp files.
+'''
+
+import os
+import re
+import json
+import mmap
+import glob
+import heapq
+import struct
+import logging
+import tempfile
+import itertools
+from beansdbadmin.core.hint import HintFile, iter_new_hint_items
+from beansdbadmin.core.hash import get_khash64
+
+MAGIC = 'KIDX'
+HEADER_FMT = '<4sIQ'
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+ENTRY_FMT = '<QHIiH'
+ENTRY_SIZE = struct.calcsize(ENTRY_FMT)
+INDEX_SUFFIX = '.kidx'
+HINT_SUFFIXES = ('.idx.s', '.hint.qlz')
+SORT_RUN_SIZE = 1 << 20  # entries sorted in memory at once
+MERGE_FANIN = 64  # sorted streams open at once
+RUN_READ_ENTRIES = 4096
+
+hint_name_regx = re.compile(r'^([0-9]{3})\.')
+
+# entry tuple field indexes
+E_KHASH = 0
+E_CHUNK = 1
+E_POS = 2
+E_VER = 3
+E_VHASH = 4
+
+
+def get_index_path(bucket_dir):
+    return bucket_dir.rstrip('/') + INDEX_SUFFIX
+
+
+def get_hint_chunk(hint_path):
+    m = hint_name_regx.match(os.path.basename(hint_path))
+    if m is not None:
+        return int(m.group(1))
+
+
+def scan_hints(bucket_dir):
+    ''' return {basename: (chunk, size, mtime)} of hints in bucket_dir '''
+    hints = dict()
+    for suffix in HINT_SUFFIXES:
+        for path in glob.glob(os.path.join(bucket_dir, '*' + suffix)):
+            chunk = get_hint_chunk(path)
+            if chunk is None:
+                continue
+            st = os.stat(path)
+            hints[os.path.basename(path)] = (chunk, st.st_size, int(st.st_mtime))
+    return hints
+
+
+def iter_hint_entries(hint_path, chunk):
+    ''' entries of a hint, sorted by khash if it is a new one '''
+    if hint_path.endswith('.idx.s'):
+        for _, (khash, pos, ver, vhash) in iter_new_hint_items(hint_path):
+            yield (khash, chunk, pos & 0xffffff00, ver, vhash)
+        return
+    for key, (_, pos, ver, vhash), _ in HintFile(hint_path):
+        yield (get_khash64(key), chunk, pos & 0xffffff00, ver, vhash)
+
+
+def check_sorted(entries, name):
+    last = 0
+    for e in entries:
+        if e[E_KHASH] < last:
+            raise ValueError("%s is not sorted by khash" % name)
+        last = e[E_KHASH]
+        yield e
+
+
+def _iter_run(f):
+    f.seek(0)
+    while True:
+        data = f.read(ENTRY_SIZE * RUN_READ_ENTRIES)
+        if not data:
+            break
+        for off in xrange(0, len(data), ENTRY_SIZE):
+            yield struct.unpack_from(ENTRY_FMT, data, off)
+    f.close()
+
+
+def _spill(entries, dir_):
+    ''' write entries to a temp file, return an iterator reading them back '''
+    f = tempfile.TemporaryFile(dir=dir_)
+    for e in entries:
+        f.write(struct.pack(ENTRY_FMT, *e))
+    return _iter_run(f)
+
+
+def merge_entries(iters, dir_=None):
+    ''' heapq.merge of sorted iters, with no more than MERGE_FANIN of them
+        read at once, groups of them are merged into temp files first'''
+    iters = list(iters)
+    while len(iters) > MERGE_FANIN:
+        group, iters = iters[:MERGE_FANIN], iters[MERGE_FANIN:]
+        iters.append(_spill(heapq.merge(*group), dir_))
+    return heapq.merge(*iters)
+
+
+def sort_entries(entries, dir_=None):
+    ''' return an iterator of entries in sorted order, with no more than
+        SORT_RUN_SIZE of them in memory, sorted runs are spilled to temp
+        files in dir_ and merged'''
+    runs = []
+    buf = []
+    for e in entries:
+        buf.append(e)
+        if len(buf) >= SORT_RUN_SIZE:
+            buf.sort()
+            runs.append(_spill(buf, dir_))
+            buf = []
+    buf.sort()
+    if not runs:
+        return iter(buf)
+    runs.append(iter(buf))
+    return merge_entries(runs, dir_)
+
+
+class KhashIndex(object):
+
+    def __init__(self, bucket_dir, path=None):
+        self.bucket_dir = bucket_dir
+        self.path = path or get_index_path(bucket_dir)
+        self.manifest = dict()
+        self.count = 0
+        self.f = None
+        self.mm = None
+        self.load()
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def load(self):
+        self.close()
+        self.manifest = dict()
+        self.count = 0
+        if not os.path.exists(self.path):
+            return
+        self.f = open(self.path, 'rb')
+        magic, manifest_len, count = struct.unpack(
+            HEADER_FMT, self.f.read(HEADER_SIZE))
+        if magic != MAGIC:
+            raise ValueError("%s is not a khash index" % self.path)
+        manifest = json.loads(self.f.read(manifest_len))
+        self.manifest = dict((str(k), tuple(v)) for k, v in manifest.items())
+        self.count = count
+        self.entries_off = HEADER_SIZE + manifest_len
+        if count > 0:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get_entry(self, i):
+        return struct.unpack_from(ENTRY_FMT, self.mm,
+                                  self.entries_off + i * ENTRY_SIZE)
+
+    def get_khash(self, i):
+        return struct.unpack_from('<Q', self.mm,
+                                  self.entries_off + i * ENTRY_SIZE)[0]
+
+    def iter_entries(self):
+        for i in xrange(self.count):
+            yield self.get_entry(i)
+
+    def lookup(self, khash):
+        ''' return [(khash, chunk, pos, ver, vhash)] of khash,
+            sorted by chunk, so the last one is the newest'''
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_khash(mid) < khash:
+                lo = mid + 1
+            else:
+                hi = mid
+        res = []
+        while lo < self.count and self.get_khash(lo) == khash:
+            res.append(self.get_entry(lo))
+            lo += 1
+        return res
+
+    def update(self):
+        ''' index new hints and reindex chunks whose hints changed or gone,
+            return True if the index file is rewritten'''
+        hints = scan_hints(self.bucket_dir)
+        old = self.manifest
+        stale_chunks = set([v[0] for (k, v) in old.items()
+                            if hints.get(k) != v])
+        to_add = sorted([k for (k, v) in hints.items()
+                         if k not in old or v[0] in stale_chunks])
+        if not stale_chunks and not to_add:
+            return False
+
+        dir_ = os.path.dirname(self.path)
+        streams = []
+        old_hints = []
+        for name in to_add:
+            chunk = hints[name][0]
+            path = os.path.join(self.bucket_dir, name)
+            if name.endswith('.idx.s'):
+                streams.append(check_sorted(iter_hint_entries(path, chunk), path))
+            else:
+                old_hints.append(iter_hint_entries(path, chunk))
+        if old_hints:
+            streams.append(sort_entries(itertools.chain(*old_hints), dir_))
+        kept = (e for e in self.iter_entries()
+                if e[E_CHUNK] not in stale_chunks)
+        self._write(hints, merge_entries([kept] + streams, dir_))
+        logging.info("khash index %s: %d hints added, chunks %s reindexed, %d entries",
+                     self.path, len(to_add), sorted(stale_chunks), self.count)
+        return True
+
+    def _write(self, manifest, entries):
+        tmp = self.path + '.tmp'
+        manifest_data = json.dumps(manifest, sort_keys=True)
+        count = 0
+        with open(tmp, 'wb') as f:
+            f.write(struct.pack(HEADER_FMT, MAGIC, len(manifest_data), 0))
+            f.write(manifest_data)
+            for e in entries:
+                f.write(struct.pack(ENTRY_FMT, *e))
+                count += 1
+            f.seek(0)
+            f.write(struct.pack(HEADER_FMT, MAGIC, len(manifest_data), count))
+        self.close()
+        os.rename(tmp, self.path)
+        self.load()
+
+
+def get_bucket_index(bucket_dir, path=None):
+    ''' open the index of bucket_dir, build or update it if needed,
+        path defaults to get_index_path(bucket_dir), next to the bucket'''
+    index = KhashIndex(bucket_dir, path)
+    index.update()
+    return index
@@ -7,6 +7,7 @@ import logging
 import subprocess
 
 from beansdbadmin.core.client import get_url_content
+from beansdbadmin.core.http_pool import get_urls
 
 ERR_RSYNC_NOT_FOUND = "rsync client not found"
 ERR_RSYNC_WORKING = "rsync client runnnig"
@@ -84,17 +85,20 @@ class Client(object):
 
 class HttpClient(Client):
 
-    def get_http(self, query, log=True):
-        url = 'http://%s:%d/%s' % (self.host, self.port, query)
+    def get_url(self, query):
+        return 'http://%s:%d/%s' % (self.host, self.port, query)
+
+    def get_http(self, query, log=True, retry=True):
+        url = self.get_url(query)
         if log:
             logger.info(url)
         else:
             logger.debug(url)
-        content = get_url_content(url)
+        content = get_url_content(url, retry)
         return content
 
-    def get_http_json(self, query, log=True):
-        ret = self.get_http(query, log)
+    def get_http_json(self, query, log=True, retry=True):
+        ret = self.get_http(query, log, retry)
         try:
             return json.loads(ret)
         except ValueError as e:
@@ -102,6 +106,22 @@ class HttpClient(Client):
             raise e
 
 
+def get_http_json_multi(clients, query):
+    ''' query all the clients concurrently, return [(client, result)],
+        result of a failed one is the exception'''
+    contents = get_urls([c.get_url(query) for c in clients])
+    res = []
+    for c, content in zip(clients, contents):
+        if not isinstance(content, Exception):
+            try:
+                content = json.loads(content)
+            except ValueError as e:
+                logger.error("%s %s not json: %s ", c, query, content)
+                content = e
+        res.append((c, content))
+    return res
+
+
 class WebClient(HttpClient):
 
     def get_config(self):
@@ -171,6 +191,9 @@ class AgentClient(HttpClient):
     def buckets(self):
         return self.get_http("buckets")
 
+    def garbage(self, bucket, sample=1):
+        return self.get_http_json("garbage/%s?sample=%d" % (bucket, sample))
+
     @dec_rsync
     def rsync_prepare(self, buckets, disk, size):
         bkts = ",".join(buckets)
@@ -178,9 +201,11 @@ class AgentClient(HttpClient):
                                   (bkts, disk, size))
 
     @dec_rsync
-    def rsync_start(self, bucket, disk, size, src):
-        return self.get_http_json("rsync/start/%s?disk=%s&size=%s&src=%s" %
-                                  (bucket, disk, size, src))
+    def rsync_start(self, bucket, disk, size, src, src_disk=None):
+        query = "rsync/start/%s?disk=%s&size=%s&src=%s" % (bucket, disk, size, src)
+        if src_disk:
+            query += "&src_disk=%s" % src_disk
+        return self.get_http_json(query, retry=False)
 
     @dec_rsync
     def rsync_state(self, bucket, disk):
@@ -188,11 +213,11 @@ class AgentClient(HttpClient):
 
     @dec_rsync
     def rsync_commit(self, bucket):
-        return self.get_http_json("rsync/commit/%s" % bucket)
+        return self.get_http_json("rsync/commit/%s" % bucket, retry=False)
 
     @dec_rsync
     def rsync_kill(self, bucket):
-        return self.get_http_json("rsync/kill/%s" % bucket)
+        return self.get_http_json("rsync/kill/%s" % bucket, retry=False)
 
 
 class RsyncClient(Client):
@@ -5,6 +5,8 @@
 import os
 import re
 import glob
+import errno
+import threading
 import subprocess
 import collections
 import time
@@ -33,7 +35,99 @@ def get_disk_free(path, is_disk=False):
     return path, s.f_bfree * s.f_bsize
 
 
+# data and hint files, also as rsync temp files, e.g. .000.data.Xy3zQw
+du_file_regx = re.compile(
+    r'^\.?[0-9]{3}\.(data|hint\.qlz|[0-9]{3}\.idx\.[a-z]+)(\.[A-Za-z0-9]{6})?$')
+
+
+class DirSizeTracker(object):
+    '''sizes of bucket dirs, in KB like `du -s`, counting only data and
+    hint files.
+
+    the files of a dir and their sizes are cached until the mtime of the
+    dir changes, i.e. a file is added, removed or renamed over, then the
+    files of that dir are stat again. only the active files, the highest
+    data chunk which gobeansdb appends to and rsync temp files, are stat on
+    every call, so a call costs a stat of each dir and of its active files.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # path -> (mtime, {file name: size}, sub dirs, active file names)
+        self.dirs = dict()
+
+    def _list(self, dir_path):
+        mtime = os.stat(dir_path).st_mtime
+        with self.lock:
+            cached = self.dirs.get(dir_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1:]
+        sizes, subdirs = dict(), []
+        for name in os.listdir(dir_path):
+            path = os.path.join(dir_path, name)
+            if du_file_regx.match(name):
+                size = self._stat(path)
+                if size is None:
+                    mtime = None  # removed since listed, list again
+                else:
+                    sizes[name] = size
+            elif os.path.isdir(path) and not os.path.islink(path):
+                subdirs.append(name)
+        active = get_active_files(sizes)
+        with self.lock:
+            self.dirs[dir_path] = (mtime, sizes, subdirs, active)
+        return sizes, subdirs, active
+
+    def _stat(self, path):
+        ''' bytes used by the file, None if it is gone '''
+        try:
+            return os.lstat(path).st_blocks * 512
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _size(self, dir_path):
+        sizes, subdirs, active = self._list(dir_path)
+        size = 0
+        for name, file_size in sizes.items():
+            if name in active:
+                file_size = self._stat(os.path.join(dir_path, name)) or 0
+                sizes[name] = file_size
+            size += file_size
+        for name in subdirs:
+            size += self._size(os.path.join(dir_path, name))
+        return size
+
+    def get(self, dir_path):
+        return self._size(dir_path) // 1024
+
+    def forget(self, dir_path):
+        with self.lock:
+            for p in self.dirs.keys():
+                if p == dir_path or p.startswith(dir_path.rstrip('/') + '/'):
+                    self.dirs.pop(p)
+
+
+def get_active_files(names):
+    ''' names of files which may grow in place: the highest data chunk,
+        and rsync temp files (.000.data.Xy3zQw) '''
+    active = set(name for name in names if name.startswith('.'))
+    chunks = [name for name in names if name.endswith('.data')
+              and not name.startswith('.')]
+    if chunks:
+        active.add(max(chunks))
+    return active
+
+
+dir_sizes = DirSizeTracker()
+
+
 def du(dir_path):
+    ''' KB of data and hint files under dir_path '''
+    return dir_sizes.get(dir_path)
+
+
+def du_all(dir_path):
+    ''' KB of all files under dir_path, by `du -s` '''
     cmd = ['du', '-s', dir_path]
     for loop in range(3):
         try:
@@ -202,6 +296,51 @@ def get_disk(path, real=True):
     return '/' + os.path.split(p)[0]
 
 
+def get_mount_point(path):
+    '''return /data1 for /data1/xxx/yyy/doubandb/1/2/zzz.data,
+    if /data1 is a mount point, i.e. the physical disk of path'''
+    p = os.path.realpath(path)
+    while not os.path.ismount(p):
+        p = os.path.dirname(p)
+    return p
+
+
+def get_device(mount_point):
+    ''' return the device name of mount_point as in psutil.disk_io_counters '''
+    import psutil
+    best = None
+    for p in psutil.disk_partitions(all=True):
+        mp = p.mountpoint.rstrip('/') + '/'
+        if (mount_point.rstrip('/') + '/').startswith(mp):
+            if best is None or len(p.mountpoint) > len(best.mountpoint):
+                best = p
+    if best is not None:
+        return os.path.basename(os.path.realpath(best.device))
+
+
+class DiskUtil(object):
+    '''utilization of the device of a disk, from its busy time
+    between calls of update'''
+
+    def __init__(self, disk):
+        self.disk = disk
+        self.device = get_device(disk)
+        self.last = None  # (time, busy_time in ms)
+        self.util = 0.0
+
+    def update(self):
+        import psutil
+        counters = psutil.disk_io_counters(perdisk=True).get(self.device)
+        if counters is None or not hasattr(counters, 'busy_time'):
+            return self.util
+        now = time.time()
+        if self.last is not None and now > self.last[0]:
+            busy = (counters.busy_time - self.last[1]) / 1000.0
+            self.util = min(1.0, max(0.0, busy / (now - self.last[0])))
+        self.last = (now, counters.busy_time)
+        return self.util
+
+
 def change_path_dbhome(file_path, new_home, db_depth):
     _, buckets, fid, suffix = parse_path(file_path, depth=db_depth)
     if suffix:
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''rebuild the .idx.s hints of data files, e.g. after hints are lost
+or removed by check_data_hint_integrity, or convert old .hint.qlz hints
+to .idx.s ones.
+
+each data file is scanned once with plain reads rather than a mmap, so
+a bad sector is a skipped region and not a SIGBUS: crc is not checked
+and only the first and last 512 bytes of a value are hashed for its
+vhash (all of it if compressed).
+chunks are rebuilt in a process pool per disk, so that no more than
+procs_per_disk files are read from a disk at once.
+
+an old hint is one quicklz block, so memory is NOT bounded in converting
+it: the compressed file and the whole decompressed hint are in memory at
+once. only its items are not all kept as python objects: they are
+spilled in the new item layout to CONVERT_PARTS temp files by khash
+range (in the bucket dir, or tmp_dir), which are then sorted and written
+one by one.
+
+    python -m beansdbadmin.core.rebuild_hint -d /data1/beansdb,/data2/beansdb
+    python -m beansdbadmin.core.rebuild_hint -d /data1/beansdb --old --tmp-dir /tmp
+'''
+
+import os
+import json
+import time
+import logging
+import struct
+import tempfile
+import collections
+import multiprocessing
+
+import quicklz
+
+from beansdbadmin.core.data import (
+    DataFile, decompress, FLAG_COMPRESS, R_KEY, R_VALUE, R_FLAG, R_VER)
+from beansdbadmin.core.hint import (
+    write_new_hint, get_new_hint_name, parse_old_hint, parse_new_hint_body,
+    NewHintWriter)
+from beansdbadmin.core.hash import get_khash64, get_vhash
+from beansdbadmin.core.path import (
+    get_files_with_suffix, parse_path, get_mount_point, home_to_homes,
+    make_basename)
+
+CONVERT_PARTS = 16  # khash ranges of an old hint sorted apart
+
+
+def get_value_vhash(value, flag):
+    if flag & FLAG_COMPRESS:
+        value = decompress(value)
+    return get_vhash(value)
+
+
+def build_hint(data_path, chunk_id, hint_path=None):
+    ''' write the hint of data_path, the newest record of each key in it,
+        return (num_items, num_bad)'''
+    if hint_path is None:
+        hint_path = os.path.join(os.path.dirname(data_path),
+                                 get_new_hint_name(chunk_id))
+    items = dict()
+    with DataFile(data_path, check_crc=False, decompress_value=False,
+                  stop_on_bad=False, resync=True) as f:
+        for pos, rec in f:
+            if rec is None:
+                logging.warning("%s: bad record at %x, skipped to %x: %s",
+                                data_path, pos, f.pos(), f.get_last_error())
+                continue
+            key = str(rec[R_KEY])
+            items[key] = (key, get_khash64(key), chunk_id, pos, rec[R_VER],
+                          get_value_vhash(rec[R_VALUE], rec[R_FLAG]))
+        num_bad = f.num_bad
+    write_new_hint(hint_path, items.values(), os.path.getsize(data_path))
+    return len(items), num_bad
+
+
+def convert_old_hint(old_path, chunk_id, hint_path=None, datasize=None,
+                     tmp_dir=None):
+    ''' write old_path as a new hint, datasize defaults to the size of
+        the data file next to it, return (num_items, 0);
+        the old hint is decompressed in memory as a whole, its items are
+        spilled to temp files in tmp_dir, default the dir of old_path'''
+    dir_ = os.path.dirname(old_path)
+    if hint_path is None:
+        hint_path = os.path.join(dir_, get_new_hint_name(chunk_id))
+    if datasize is None:
+        data_path = os.path.join(dir_, make_basename(chunk_id, 'data'))
+        datasize = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+
+    parts = [tempfile.TemporaryFile(dir=tmp_dir or dir_)
+             for _ in range(CONVERT_PARTS)]
+    try:
+        with open(old_path, 'rb') as f:
+            hint_data = quicklz.decompress(f.read())
+        for key, (_, pos, ver, vhash), _ in parse_old_hint(hint_data):
+            khash = get_khash64(key)
+            part = parts[khash * CONVERT_PARTS >> 64]
+            part.write(struct.pack('QiIiHB', khash, chunk_id, pos, ver, vhash,
+                                   len(key)))
+            part.write(key)
+        del hint_data
+
+        w = NewHintWriter(hint_path)
+        try:
+            for part in parts:
+                part.seek(0)
+                items = [(key, khash, chunk_id, pos, ver, vhash)
+                         for key, (khash, pos, ver, vhash), _
+                         in parse_new_hint_body(part.read())]
+                items.sort(key=lambda it: (it[1], it[3]))
+                for it in items:
+                    w.add(*it)
+                part.close()
+        except Exception:
+            w.abort()
+            raise
+        return w.close(datasize), 0
+    finally:
+        for part in parts:
+            part.close()
+
+
+def _hint_task(task):
+    func, bucket, chunk_id, src_path, hint_path, kwargs = task
+    r = dict(bucket="".join("%x" % x for x in bucket), chunk=chunk_id,
+             src=src_path, hint=hint_path)
+    start = time.time()
+    try:
+        r['count'], r['bad'] = func(src_path, chunk_id, hint_path, **kwargs)
+        r['ok'] = True
+    except Exception as e:
+        logging.exception("write hint %s failed", hint_path)
+        r['ok'] = False
+        r['err'] = "%s: %s" % (type(e).__name__, e)
+    r['time'] = time.time() - start
+    return r
+
+
+def _get_hint_tasks(func, suffix, db_homes, db_depth, bucket=None,
+                    overwrite=False, kwargs=None):
+    tasks = []
+    for src_path in get_files_with_suffix(db_homes, [suffix], db_depth):
+        _, buckets, chunk_id, _ = parse_path(src_path, depth=db_depth)
+        if chunk_id is None:
+            continue
+        buckets = tuple([int(x, 16) for x in buckets])
+        if bucket is not None and buckets[:len(bucket)] != bucket:
+            continue
+        hint_path = os.path.join(os.path.dirname(src_path),
+                                 get_new_hint_name(chunk_id))
+        if os.path.exists(hint_path) and not overwrite:
+            continue
+        tasks.append((func, buckets, chunk_id, src_path, hint_path,
+                      kwargs or {}))
+    return tasks
+
+
+def rebuild_hints_parallel(db_homes, db_depth, bucket=None, overwrite=False,
+                           procs_per_disk=1, report_path=None, old=False,
+                           tmp_dir=None):
+    '''rebuild missing hints (all of them with overwrite) of data files
+    under db_homes, over a process pool per disk; with old, convert them
+    from old hints instead of data files, spilling to tmp_dir if given.
+
+    return a report dict, also dumped as json to report_path if given.
+    '''
+    if old:
+        tasks = _get_hint_tasks(convert_old_hint, '.hint.qlz', db_homes,
+                                db_depth, bucket, overwrite,
+                                {'tmp_dir': tmp_dir})
+    else:
+        tasks = _get_hint_tasks(build_hint, '.data', db_homes, db_depth,
+                                bucket, overwrite)
+    disk_tasks = collections.defaultdict(list)
+    for task in tasks:
+        disk_tasks[get_mount_point(task[3])].append(task)
+
+    start = time.time()
+    pools = []
+    for disk, tasks_ in disk_tasks.items():
+        pool = multiprocessing.Pool(min(procs_per_disk, len(tasks_)))
+        pools.append((disk, pool, pool.map_async(_hint_task,
+                                                 tasks_, chunksize=1)))
+    results = []
+    for disk, pool, async_result in pools:
+        pool.close()
+        for r in async_result.get():
+            r['disk'] = disk
+            results.append(r)
+        pool.join()
+    results.sort(key=lambda r: (r['bucket'], r['chunk']))
+
+    errors = [r for r in results if not r['ok']]
+    report = {'db_homes': list(home_to_homes(db_homes)),
+              'db_depth': db_depth,
+              'time': time.time() - start,
+              'num_rebuilt': len(results) - len(errors),
+              'num_error': len(errors),
+              'errors': errors,
+              'results': results}
+    if report_path is not None:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="rebuild .idx.s hints from data files or old hints")
+    parser.add_argument('-d', '--db-homes', required=True,
+                        help="comma separated")
+    parser.add_argument('--depth', type=int, default=1)
+    parser.add_argument('-b', '--bucket', help="e.g. 0f, default all")
+    parser.add_argument('-j', '--procs-per-disk', type=int, default=1)
+    parser.add_argument('-f', '--overwrite', action='store_true',
+                        help="also rebuild existing hints")
+    parser.add_argument('-r', '--report', help="path of a json report")
+    parser.add_argument('--old', action='store_true',
+                        help="convert from .hint.qlz instead of data files; "
+                        "each old hint is decompressed in memory as a whole")
+    parser.add_argument('--tmp-dir', help="for temp files of --old, "
+                        "default the bucket dir")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    bucket = None
+    if args.bucket is not None:
+        bucket = tuple(int(c, 16) for c in args.bucket)
+    report = rebuild_hints_parallel(args.db_homes.split(','), args.depth,
+                                    bucket, args.overwrite,
+                                    args.procs_per_disk, args.report,
+                                    args.old, args.tmp_dir)
+    for r in report['errors']:
+        logging.error("%s: %s", r['src'], r['err'])
+    logging.info("rebuilt %d hints in %.1fs, %d errors",
+                 report['num_rebuilt'], report['time'], report['num_error'])
+
+
+if __name__ == "__main__":
+    main()
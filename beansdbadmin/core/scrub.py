@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# encoding: utf-8
+'''verify the crc of every record of every data file of a node in
+background, so bit-rot is found before a replica is needed.
+
+one thread per disk reads its data files with plain reads, never a mmap
+(a bad sector would be a SIGBUS killing the agent), at most SCRUB_RATE
+bytes/s, pausing while the disk is busier than SCRUB_MAX_UTIL.
+the position in a file is checkpointed to sqlite every SCRUB_BLOCK bytes,
+a restarted scrubber continues from there; bad records (chunk, pos, key)
+are kept in the same db, a bad region, including one failing to read, is
+skipped to the next record with a valid crc and reported once.
+
+a file is scrubbed again SCRUB_CYCLE after it was done, or at once if its
+mtime changed (e.g. rewritten by gc); files modified in the last
+SCRUB_MIN_AGE, like the chunk being written, are left for later.
+
+    python -m beansdbadmin.core.scrub -d /var/lib/beansdb --db scrub.db
+'''
+
+import os
+import time
+import logging
+import sqlite3
+import threading
+import collections
+
+from beansdbadmin.core.data import (
+    DataFile, parse_header, REC_HEAD_SIZE, MAX_KEY_LEN)
+from beansdbadmin.core.path import (
+    get_files_with_suffix, get_mount_point, parse_basename, DiskUtil)
+
+logger = logging.getLogger(__name__)
+
+SCRUB_RATE = 20 << 20  # bytes/s per disk
+SCRUB_BLOCK = 16 << 20  # bytes between throttle and checkpoint
+SCRUB_MAX_UTIL = 0.5
+SCRUB_BUSY_WAIT = 10  # seconds
+SCRUB_CYCLE = 7 * 24 * 3600
+SCRUB_MIN_AGE = 3600
+SCRUB_IDLE_INTERVAL = 600
+SCRUB_BAD_PAGE_SIZE = 100
+
+
+class ScrubRecord(object):
+    '''checkpoints and bad records in sqlite, one per thread'''
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        self.create_table()
+
+    def create_table(self):
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS scrub_file (
+                            path TEXT PRIMARY KEY,
+                            mtime INTEGER,
+                            pos INTEGER,
+                            finish_time INTEGER)
+                            """)
+        self.cursor.execute("""CREATE TABLE IF NOT EXISTS scrub_bad (
+                            id INTEGER PRIMARY KEY,
+                            path TEXT,
+                            chunk INTEGER,
+                            pos INTEGER,
+                            key TEXT,
+                            err TEXT,
+                            found_time INTEGER)
+                            """)
+        self.cursor.execute("""CREATE INDEX IF NOT EXISTS scrub_bad_path
+                            ON scrub_bad (path)""")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def get_file(self, path):
+        ''' return (mtime, pos, finish_time) or None '''
+        self.cursor.execute("SELECT mtime, pos, finish_time FROM scrub_file "
+                            "WHERE path=?", (path,))
+        return self.cursor.fetchone()
+
+    def save_file(self, path, mtime, pos, finish_time=None):
+        self.cursor.execute("INSERT OR REPLACE INTO scrub_file "
+                            "(path, mtime, pos, finish_time) "
+                            "VALUES (?, ?, ?, ?)",
+                            (path, mtime, pos, finish_time))
+        self.conn.commit()
+
+    def clear_bad(self, path):
+        self.cursor.execute("DELETE FROM scrub_bad WHERE path=?", (path,))
+        self.conn.commit()
+
+    def add_bad(self, path, chunk, pos, key, err):
+        self.cursor.execute("INSERT INTO scrub_bad "
+                            "(path, chunk, pos, key, err, found_time) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            (path, chunk, pos, key, err, int(time.time())))
+        self.conn.commit()
+
+    def get_bad(self, limit=SCRUB_BAD_PAGE_SIZE):
+        ''' return the newest bad records, as dicts '''
+        self.cursor.execute("SELECT path, chunk, pos, key, err, found_time "
+                            "FROM scrub_bad ORDER BY id DESC LIMIT ?",
+                            (limit,))
+        names = ('path', 'chunk', 'pos', 'key', 'err', 'found_time')
+        return [dict(zip(names, r)) for r in self.cursor.fetchall()]
+
+    def count_bad(self):
+        self.cursor.execute("SELECT COUNT(*) FROM scrub_bad")
+        return self.cursor.fetchone()[0]
+
+
+def get_disk_data_files(db_homes, db_depth):
+    ''' return {mount point: [real path of data files]} '''
+    disks = collections.defaultdict(list)
+    for path in get_files_with_suffix(db_homes, ['.data'], db_depth):
+        path = os.path.realpath(path)
+        disks[get_mount_point(path)].append(path)
+    return disks
+
+
+def get_bad_key(f, pos):
+    ''' the key of a bad record in file f, if its header is still sane '''
+    try:
+        f.seek(pos, 0)
+        block = f.read(REC_HEAD_SIZE + MAX_KEY_LEN)
+        ksz = parse_header(block)[4]
+        if 0 < ksz <= MAX_KEY_LEN:
+            key = block[REC_HEAD_SIZE:REC_HEAD_SIZE + ksz]
+            return key.encode('string_escape')
+    except Exception:
+        return None
+
+
+class DiskScrubber(object):
+
+    def __init__(self, disk, db_homes, db_depth, db_path, rate=SCRUB_RATE):
+        self.disk = disk
+        self.db_homes = db_homes
+        self.db_depth = db_depth
+        self.db_path = db_path
+        self.rate = rate
+        self.util = DiskUtil(disk)
+        self.next_time = 0  # when the bytes read so far are paid
+        self.path = None
+        self.pos = 0
+        self.scrubbed = 0
+        self.num_bad = 0
+        self.paused = False
+        self.thread = None
+
+    def throttle(self, nbytes):
+        now = time.time()
+        self.next_time = max(self.next_time, now) + float(nbytes) / self.rate
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+        while self.util.update() > SCRUB_MAX_UTIL:
+            self.paused = True
+            time.sleep(SCRUB_BUSY_WAIT)
+        self.paused = False
+
+    def next_file(self, db):
+        ''' the due file scrubbed longest ago, None if none is due '''
+        files = get_disk_data_files(self.db_homes, self.db_depth)
+        now = time.time()
+        due = []
+        for path in files.get(self.disk, []):
+            mtime = int(os.path.getmtime(path))
+            if now - mtime < SCRUB_MIN_AGE:
+                continue
+            row = db.get_file(path)
+            if row is None or row[0] != mtime or row[2] is None:
+                due.append((0, path))
+            elif now - row[2] >= SCRUB_CYCLE:
+                due.append((row[2], path))
+        if due:
+            return min(due)[1]
+
+    def scrub_file(self, db, path):
+        mtime = int(os.path.getmtime(path))
+        row = db.get_file(path)
+        pos = 0
+        if row is not None and row[0] == mtime and row[2] is None:
+            pos = row[1]
+        if pos == 0:
+            db.clear_bad(path)
+        chunk, _ = parse_basename(os.path.basename(path))
+        logger.info("scrub %s from %x", path, pos)
+
+        self.path, self.pos = path, pos
+        with DataFile(path, decompress_value=False, stop_on_bad=False,
+                      resync=True) as f:
+            f.seek(pos)
+            for rpos, rec in f:
+                if rec is None:
+                    end = f.pos()
+                    err = "%s, skipped to %x" % (f.get_last_error(), end)
+                    key = get_bad_key(f.f, rpos)
+                    f.seek(end)
+                    logger.error("scrub %s: bad record at %x, key %s: %s",
+                                 path, rpos, key, err)
+                    db.add_bad(path, chunk, rpos, key, err)
+                    self.num_bad += 1
+                if f.pos() - self.pos >= SCRUB_BLOCK:
+                    self.throttle(f.pos() - self.pos)
+                    self.scrubbed += f.pos() - self.pos
+                    self.pos = f.pos()
+                    db.save_file(path, mtime, self.pos)
+            self.throttle(f.pos() - self.pos)
+            self.scrubbed += f.pos() - self.pos
+            db.save_file(path, mtime, f.pos(), int(time.time()))
+        self.path = None
+
+    def run(self):
+        db = ScrubRecord(self.db_path)
+        while True:
+            try:
+                path = self.next_file(db)
+                if path is not None:
+                    self.scrub_file(db, path)
+                    continue
+            except Exception:
+                logger.exception("scrub %s failed", self.disk)
+                self.path = None
+            time.sleep(SCRUB_IDLE_INTERVAL)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run,
+                                           name="scrub %s" % self.disk)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def summary(self):
+        return {'path': self.path,
+                'pos': self.pos,
+                'scrubbed': self.scrubbed,
+                'bad': self.num_bad,
+                'util': round(self.util.util, 3),
+                'paused': self.paused}
+
+
+class Scrubber(object):
+    '''a DiskScrubber for each disk with data files'''
+
+    def __init__(self, db_homes, db_depth, db_path, rate=SCRUB_RATE):
+        self.db_homes = db_homes
+        self.db_depth = db_depth
+        self.db_path = db_path
+        self.rate = rate
+        self.disks = dict()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add_disks(self):
+        ''' start scrubbers of new disks '''
+        with self.lock:
+            for disk in get_disk_data_files(self.db_homes, self.db_depth):
+                if disk not in self.disks:
+                    s = DiskScrubber(disk, self.db_homes, self.db_depth,
+                                     self.db_path, self.rate)
+                    self.disks[disk] = s
+                    s.start()
+
+    def run(self):
+        while True:
+            try:
+                self.add_disks()
+            except Exception:
+                logger.exception("find disks to scrub failed")
+            time.sleep(SCRUB_IDLE_INTERVAL)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="scrub")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def summary(self):
+        db = ScrubRecord(self.db_path)
+        try:
+            bad = db.get_bad()
+            num_bad = db.count_bad()
+        finally:
+            db.close()
+        with self.lock:
+            disks = dict((d, s.summary()) for (d, s) in self.disks.items())
+        return {'disks': disks, 'num_bad': num_bad, 'bad': bad}
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="verify crc of data files in background")
+    parser.add_argument('-d', '--db-homes', required=True,
+                        help="comma separated")
+    parser.add_argument('--depth', type=int, default=2)
+    parser.add_argument('--db', default='scrub.db', help="sqlite path")
+    parser.add_argument('--rate', type=int, default=SCRUB_RATE >> 20,
+                        help="MB/s per disk")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    scrubber = Scrubber(args.db_homes.split(','), args.depth, args.db,
+                        args.rate << 20)
+    scrubber.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,18 +6,38 @@
 import json
 from collections import defaultdict
 from beansdbadmin.core.client import get_url_content
+from beansdbadmin.core.http_pool import get_urls
 
 
 GOBEANSDB_WEB_PORT = 7903
 
 
 # helper
-def get_http(server, query, port=GOBEANSDB_WEB_PORT):
+def get_http(server, query, port=GOBEANSDB_WEB_PORT, retry=True):
     url = 'http://%s:%d/%s' % (server, port, query)
-    content = get_url_content(url)
+    content = get_url_content(url, retry)
     return content
 
 
+def get_http_multi(servers, query, port=GOBEANSDB_WEB_PORT):
+    ''' return {server: content} of all servers, fetched concurrently,
+        content of a failed server is the exception'''
+    urls = ['http://%s:%d/%s' % (s, port, query) for s in servers]
+    return dict(zip(servers, get_urls(urls)))
+
+
+def get_json_multi(servers, query, port=GOBEANSDB_WEB_PORT):
+    res = dict()
+    for s, content in get_http_multi(servers, query, port).items():
+        if not isinstance(content, Exception):
+            try:
+                content = json.loads(content)
+            except ValueError as e:
+                content = e
+        res[s] = content
+    return res
+
+
 # pages
 def get_config(server):
     v = json.loads(get_http(server, "config"))
@@ -70,6 +90,10 @@ def get_bucket_all(server, port=GOBEANSDB_WEB_PORT):
     return json.loads(get_http(server, "bucket/all", port))
 
 
+def get_bucket_all_multi(servers, port=GOBEANSDB_WEB_PORT):
+    return get_json_multi(servers, "bucket/all", port)
+
+
 def int2hex(d, depth=1):
     format = '%%0%dx' % depth
     if isinstance(d, int):
@@ -57,8 +57,10 @@
 import time
 import sys
 import logging
+import threading
 import quicklz
 from collections import defaultdict, Counter
+from multiprocessing.dummy import Pool as ThreadPool
 from beansdbadmin.core.hash import get_vhash
 from beansdbadmin.core.client import DBClient
 
@@ -76,6 +78,10 @@ MAX_TMP = 10 << 20
 
 # 同步限制
 TS_DIFF_LARGE = 10
+MIRROR_CONCURRENCY = 1  # > 1: get_dir by a thread pool, see mirror_concurrent
+MIRROR_NWAY = False  # compare all primaries in one walk, see mirror_nway
+MIRROR_BATCH = False  # resolve conflicts of a leaf together, see ConflictBatch
+MAX_BATCH_SIZE = 200
 MAX_DIR_SIZE = 100000
 MAX_DIFF_VER = 100
 
@@ -149,6 +155,7 @@ class Conflict(object):
 
         # result
         self.result = None
+        self.writer = None  # a BatchWriter, or write at once
 
     def add(self, copy):
         self.copies.append(copy)
@@ -168,10 +175,11 @@ class Conflict(object):
         for cp in self.copies:
             self.vhash_counter[cp.vhash] += 1
 
-    def resolve(self):
+    def resolve(self, records=None):
+        '''records: {store: {khash_str: records}} got by ConflictBatch'''
         logging.info("begin conflict %s", self)
 
-        if not self.get_all():
+        if not self.get_all(records):
             return
         self.get_vhash_counts()
         self.set_vhash_counts()
@@ -183,12 +191,14 @@ class Conflict(object):
         self.set_vhash_counts()
         self.copies.sort(key=lambda x: x.cmpkey(), reverse=True)
         self.sync_all()
-        SyncWorker.count += 1
-        if SyncWorker.max_count > 0 and SyncWorker.count >= SyncWorker.max_count:
+        if SyncWorker.incr_count():
             sys.exit(0)
 
-    def get_copy(self, cp, should_have):
-        records = cp.store.get_records_by_khash(self.khash_str)
+    def get_copy(self, cp, should_have, records=None):
+        if records is None or cp.store not in records:
+            records = cp.store.get_records_by_khash(self.khash_str)
+        else:
+            records = records[cp.store].get(self.khash_str, [])
         if len(records) == 0:
             if should_have and cp.ver > 0:
                 logging.warn("can not get record for %s from %s, %s", self.khash_str, cp.store, cp)
@@ -224,19 +234,19 @@ class Conflict(object):
     def __str__(self):
         return "%s %s %s %s" % (self.tag, self.khash_str, self.copies, self.keys)
 
-    def get_all(self):
+    def get_all(self, records=None):
         servers = set()
         for cp in self.copies:
             servers.add(cp.store)
             if cp.vhash != None:
-                if not self.get_copy(cp, True):
+                if not self.get_copy(cp, True, records):
                     return
 
         for s in self.worker.primary_servers + self.worker.backup_servers:
             if s in servers:
                 continue
             cp = Copy(s)
-            self.get_copy(cp, s.role == ROLE_PRIMARY)
+            self.get_copy(cp, s.role == ROLE_PRIMARY, records)
             self.add(cp)
         return True
 
@@ -300,10 +310,10 @@ class Conflict(object):
             if max_right_ver > 0 and max_wrong_ver >= max_right_ver:
                 ver = max_wrong_ver + 1
                 for s in self.worker.primary_servers:
-                    s.set_raw(r.key, r.value, ver, r.flag, r.vhash)
+                    self.set_raw(s, r.key, r.value, ver, r.flag, r.vhash)
             else:
                 for s in dsts:
-                    s.set_raw(r.key, r.value, ver, r.flag, r.vhash)
+                    self.set_raw(s, r.key, r.value, ver, r.flag, r.vhash)
 
         if r.vhash != self.mc_vhash:
             try:
@@ -314,7 +324,7 @@ class Conflict(object):
     def delete_all(self):
         r = self.result
         for s in self.worker.primary_servers:
-            s.delete(r.key)
+            self.delete(s, r.key)
         try:
             self.worker.mc.delete(r.key)
         except:
@@ -324,14 +334,82 @@ class Conflict(object):
         for s in self.worker.backup_servers:
             try:
                 for key in self.keys:
-                    s.delete(key)
+                    self.delete(s, key, True)
             except:
                 pass
 
+    def set_raw(self, store, key, value, ver, flag, vhash):
+        if self.writer is not None:
+            self.writer.set_raw(store, key, value, ver, flag, vhash)
+        else:
+            store.set_raw(key, value, ver, flag, vhash)
+
+    def delete(self, store, key, ignore_error=False):
+        if self.writer is not None:
+            self.writer.delete(store, key, ignore_error)
+        else:
+            store.delete(key)
+
+
+class BatchWriter(object):
+    '''collect the writes of conflicts to stores and do them by
+    set_multi/delete_multi at flush'''
+
+    def __init__(self):
+        self.sets = defaultdict(list)  # store -> [(key, value, ver, flag, vhash)]
+        self.deletes = defaultdict(list)  # (store, ignore_error) -> [key]
+
+    def set_raw(self, store, key, value, ver, flag, vhash):
+        self.sets[store].append((key, value, ver, flag, vhash))
+
+    def delete(self, store, key, ignore_error=False):
+        self.deletes[(store, ignore_error)].append(key)
+
+    def flush(self):
+        for store, items in self.sets.items():
+            store.set_raw_multi(items)
+        for (store, ignore_error), keys in self.deletes.items():
+            try:
+                store.delete_multi(keys)
+            except:
+                if not ignore_error:
+                    raise
+        self.sets.clear()
+        self.deletes.clear()
+
+
+class ConflictBatch(object):
+    '''resolve conflicts (of a leaf) together:
+    get their records from each store by one get_multi of @@khash,
+    resolve each conflict as Conflict.resolve, the priority is the same,
+    then write the results by set_multi/delete_multi.'''
+
+    def __init__(self, worker, conflicts):
+        self.worker = worker
+        self.conflicts = conflicts
+
+    def get_records(self):
+        khashes = [cf.khash_str for cf in self.conflicts]
+        records = dict()
+        for s in self.worker.primary_servers + self.worker.backup_servers:
+            records[s] = s.get_records_by_khash_multi(khashes)
+        return records
+
+    def resolve(self):
+        records = self.get_records()
+        writer = BatchWriter()
+        try:
+            for cf in self.conflicts:
+                cf.writer = writer
+                cf.resolve(records)
+        finally:
+            writer.flush()
+
 
 # DBClient 作为一个属性而非基类，为了
 #   1. 重连时不需要重建 SyncClient对象， SyncClient对象可以一直持有。
 #   2. 对接口做更明确的限制和定制。
+#   3. libmc 的 client 不是线程安全的，每个线程用自己的 DBClient。
 class SyncClient(object):
 
     '''use only set_raw and delete for writing'''
@@ -345,7 +423,7 @@ class SyncClient(object):
 
         # var
         self.role = role
-        self.client = None
+        self.local = threading.local()
         self.count = 0
         self.fail = False
         self.reconnect()
@@ -356,8 +434,15 @@ class SyncClient(object):
     def __repr__(self):
         return self.__str__()
 
+    @property
+    def client(self):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = DBClient(self.addr)
+        return client
+
     def reconnect(self):
-        self.client = DBClient(self.addr)
+        self.local.client = DBClient(self.addr)
 
     def set_raw(self, key, value, ver, flag, vhash):
         logging.info("set %s %s v %d ver %d flag 0x%x", self.addr, key, vhash, ver, flag)
@@ -374,6 +459,30 @@ class SyncClient(object):
         res = self.client.get_records_by_khash(khash_str)
         return res
 
+    def get_records_by_khash_multi(self, khash_strs):
+        return self.client.get_records_by_khash_multi(khash_strs)
+
+    def set_raw_multi(self, items):
+        '''items: [(key, value, ver, flag, vhash)],
+        set_multi can only set one version and no flag for all the keys,
+        so values with flag 0 are grouped by ver, others use set_raw'''
+        values_by_ver = defaultdict(dict)
+        for key, value, ver, flag, vhash in items:
+            if flag != 0:
+                self.set_raw(key, value, ver, flag, vhash)
+                continue
+            logging.info("set %s %s v %d ver %d flag 0x%x", self.addr, key, vhash, ver, flag)
+            values_by_ver[ver][key] = value
+        if self.pretend:
+            return
+        for ver, values in values_by_ver.items():
+            ok, failed = self.client.set_multi(values, return_failure=True, rev=ver)
+            if not ok:
+                err = "set_multi %s ver %d, failed %s, err %s" % (self.addr, ver, failed,
+                                                                 self.client.mc.get_last_strerror())
+                logging.info(err)
+                raise Exception(err)
+
     def get_dir(self, path):
         return self.client.get_dir(path)
 
@@ -387,6 +496,14 @@ class SyncClient(object):
             return
         return self.client.delete(key)
 
+    def delete_multi(self, keys):
+        if self.role != ROLE_BACKUP:
+            for key in keys:
+                logging.info("DELETE %s", (self, key))
+        if self.pretend:
+            return
+        return self.client.delete_multi(keys)
+
     def get_basic_info(self):
         self.fail = False
         self.count = 0
@@ -400,8 +517,19 @@ class SyncClient(object):
 class SyncWorker(object):
     max_count = 0
     count = 0
+    count_lock = threading.Lock()  # workers of a SyncScheduler share count
+
+    @classmethod
+    def incr_count(cls):
+        '''count a resolved conflict, return True if max_count is reached'''
+        with cls.count_lock:
+            cls.count += 1
+            return cls.max_count > 0 and cls.count >= cls.max_count
+
     def __init__(self, bucket, primary_servers, backup_servers,
-                 all_servers, depth=1, pretend=True):
+                 all_servers, depth=1, pretend=True,
+                 concurrency=MIRROR_CONCURRENCY, nway=MIRROR_NWAY,
+                 batch=MIRROR_BATCH):
         """ all_servers is from client config
             primary_servers & backup_servers from route table"""
 
@@ -436,6 +564,12 @@ class SyncWorker(object):
         self.stats = {}
         self.keys_count = 0
 
+        self.last_run = 0
+
+        self.concurrency = concurrency
+        self.nway = nway
+        self.batch = batch
+        self.pool = None
 
     def init_servers(self):
         for servers, role in zip([self.formal_primaries, self.formal_backups, self.formal_others],
@@ -458,27 +592,60 @@ class SyncWorker(object):
         self.init_servers()
         self.is_running = True
         while self.is_running:
-            self.counters.clear()
-            self.stats = {
-                "time": time.time(),
-            }
-            try:
-                self.scan_all_servers() # 重连
-
-                if self.check_primaries() and self.check_backups() and self.check_tmps():
-                    for s in self.backup_servers:
-                        self.clear_backup(s)
-                    self.mirror_primaries()
-                else:
-                    logging.info("sleep %ds", LOOP_INTERVAL_BIG)
-                    time.sleep(LOOP_INTERVAL_BIG)
-            except Exception, e:
-                logging.getLogger().exception(e)
-
-            self.log_status()
+            if not self.run_once():
+                logging.info("sleep %ds", LOOP_INTERVAL_BIG)
+                time.sleep(LOOP_INTERVAL_BIG)
             if self.is_running:
                 t = LOOP_INTERVAL if self.depth == 1 else LOOP_INTERVAL_BIG
                 time.sleep(t)
+        self.close_pool()
+
+    def run_once(self):
+        '''one sync pass of the bucket, return False if can not sync now'''
+        if not self.stores:
+            self.init_servers()
+        self.counters.clear()
+        self.stats = {
+            "time": time.time(),
+        }
+        synced = False
+        try:
+            self.scan_all_servers() # 重连
+
+            if self.check_primaries() and self.check_backups() and self.check_tmps():
+                for s in self.backup_servers:
+                    self.clear_backup(s)
+                self.mirror_primaries()
+                synced = True
+        except Exception, e:
+            logging.getLogger().exception(e)
+
+        self.log_status()
+        self.last_run = time.time()
+        return synced
+
+    def release_clients(self):
+        '''drop the connections of this thread'''
+        for store in self.stores.values():
+            store.local.client = None
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ThreadPool(self.concurrency)
+        return self.pool
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def get_dirs(self, tasks):
+        '''get_dir of [(store, path)], in parallel if concurrency > 1'''
+        get_dir = lambda t: t[0].get_dir(t[1])
+        if self.concurrency <= 1:
+            return map(get_dir, tasks)
+        return self.get_pool().map(get_dir, tasks)
 
     def check_primaries(self):
         self.primary_servers = list([self.stores.get(addr) for addr in self.formal_primaries])
@@ -547,6 +714,7 @@ class SyncWorker(object):
             return
         logging.info('clear_backup %s count %d', store, store.count)
         _dir_g = store.list_dir("@%01x" % self.bucket)
+        conflicts = []
         for khash_str, vhash, ver in _dir_g:
             logging.info('clear_backup %s %s %d %d', store, khash_str, vhash, ver)
             if not self.is_running:
@@ -555,51 +723,162 @@ class SyncWorker(object):
                 continue
             cf = Conflict(self, "TMP", khash_str)
             cf.add(Copy(store, ver, vhash))
-            cf.resolve()
+            conflicts.append(cf)
+            if not self.batch or len(conflicts) >= MAX_BATCH_SIZE:
+                self.resolve_conflicts(conflicts)
+                conflicts = []
+        self.resolve_conflicts(conflicts)
+
+    def resolve_conflicts(self, conflicts):
+        if not self.batch:
+            for cf in conflicts:
+                cf.resolve()
+            return
+        for i in range(0, len(conflicts), MAX_BATCH_SIZE):
+            ConflictBatch(self, conflicts[i:i + MAX_BATCH_SIZE]).resolve()
 
     def mirror_primaries(self):
+        if self.nway:
+            root = "@%01x" % self.bucket if self.depth == 1 else "@%02x" % self.bucket
+            return self.mirror_nway(root)
         src = self.primary_servers[0]
+        mirror = self.mirror if self.concurrency <= 1 else self.mirror_concurrent
         for dst in self.primary_servers[1:]:
             if not self.is_running:
                 return
             if dst.count < 0:
                 return
             if self.depth == 1:
-                self.mirror(src, dst, "@%01x" % (self.bucket), True)
+                mirror(src, dst, "@%01x" % (self.bucket), True)
             else:
                 logging.info('mirror2 %d %s %s', self.bucket, src, dst)
-                self.mirror(src, dst, "@%02x" % (self.bucket), True)
+                mirror(src, dst, "@%02x" % (self.bucket), True)
 
     def mirror(self, src, dst, path, isroot=False):
         if not self.is_running:
             return
         src_dir = src.get_dir(path)
         dst_dir = dst.get_dir(path)
+        for subpath in self.mirror_dir(path, src, dst, src_dir, dst_dir):
+            self.mirror(src, dst, subpath)
+
+    def mirror_concurrent(self, src, dst, path, isroot=False):
+        '''walk the htree level by level, get_dir of src and dst for all
+        differing paths of a level in parallel, with self.concurrency
+        threads, each has its own connections. conflicts are still
+        resolved in this thread.'''
+        paths = [path]
+        while paths and self.is_running:
+            tasks = [(store, p) for p in paths for store in (src, dst)]
+            dirs = self.get_dirs(tasks)
+            subpaths = []
+            for i, p in enumerate(paths):
+                if not self.is_running:
+                    return
+                src_dir, dst_dir = dirs[2 * i], dirs[2 * i + 1]
+                subpaths.extend(self.mirror_dir(p, src, dst, src_dir, dst_dir))
+            paths = subpaths
+
+    def mirror_nway(self, path):
+        '''walk the htree of all alive primaries at once: get_dir(path) of
+        every primary, descend only into children whose (hash, count)
+        are not the same on all of them, and make each conflict with the
+        copies of all primaries.'''
+        stores = list(self.primary_servers)
+        n = len(stores)
+        paths = [path]
+        while paths and self.is_running:
+            tasks = [(store, p) for p in paths for store in stores]
+            dirs = self.get_dirs(tasks)
+            subpaths = []
+            for i, p in enumerate(paths):
+                if not self.is_running:
+                    return
+                subpaths.extend(self.mirror_dir_nway(p, stores, dirs[i * n:(i + 1) * n]))
+            paths = subpaths
+
+    def mirror_dir_nway(self, path, stores, dirs):
+        '''sync leaves under path, return the subpaths to mirror'''
+        if all(d == dirs[0] for d in dirs[1:]):
+            return []
+
+        if not all(dirs):
+            logging.error("%s some dir is empty? %s ", path,
+                          [(s, bool(d)) for (s, d) in zip(stores, dirs)])
+            return []
+        leaves = [is_leaf(d) for d in dirs]
+        if not any(leaves):
+            counts = [d['0/'][1] for d in dirs]
+            if max(counts) - min(counts) > MAX_DIR_SIZE:
+                logging.error("too many, skiped: %s %s", path, zip(stores, counts))
+                return []
+            children = sorted(set().union(*dirs))
+            return [path + k[0] for k in children
+                    if len(set(d.get(k, (0, 0)) for d in dirs)) > 1]
+
+        if not all(leaves):
+            logging.info("dir2file %s, %s", path, zip(stores, leaves))
+            dirs = [d if leaf else self.get_leaf_dir(store, path, d)
+                    for (store, d, leaf) in zip(stores, dirs, leaves)]
+        self.mirror_leaf_nway(path, stores, dirs)
+        return []
+
+    def get_leaf_dir(self, store, path, d):
+        '''merge all leaves under a nonleaf dir d into one'''
+        items = dict()
+        for k in d.iterkeys():
+            subpath = path + k[0]
+            sub_dir = store.get_dir(subpath)
+            if not is_leaf(sub_dir):
+                sub_dir = self.get_leaf_dir(store, subpath, sub_dir)
+            items.update(sub_dir)
+        return items
+
+    def mirror_leaf_nway(self, path, stores, dirs):
+        conflicts = []
+        for khash_str in sorted(set().union(*dirs)):
+            metas = [d.get(khash_str) for d in dirs]
+            present = [m for m in metas if m is not None]
+            if len(present) == len(metas):
+                if len(set(vhash for (vhash, _) in metas)) == 1:
+                    continue  # same value, maybe different ver
+                tag = "M_VALUE"
+            else:
+                tag = "M_MISS"
+            if all(ver < 0 for (_, ver) in present):
+                continue  # all deleted
 
-        if isroot:
-            #logging.info('mirror1 %d %s %s', self.bucket, src, dst)
-            pass
+            cf = Conflict(self, tag, khash_str)
+            for store, meta in zip(stores, metas):
+                if meta is None:
+                    cf.add(Copy(store, 0, VHASH_DELETE))
+                else:
+                    vhash, ver = meta
+                    cf.add(Copy(store, ver, vhash))
+            conflicts.append(cf)
+        self.resolve_conflicts(conflicts)
+
+    def mirror_dir(self, path, src, dst, src_dir, dst_dir):
+        '''sync leaves under path, return the subpaths to mirror'''
         if src_dir == dst_dir:
-            if isroot:
-                #logging.info('mirror1 %d %s %s:\n%s\n%s', self.bucket, src, dst, src_dir, dst_dir)
-                pass
-            return
+            return []
 
         if not src_dir or not dst_dir:
             logging.error("%s either dir is empty? %s ", path,
                           (src, bool(src_dir), dst, bool(dst_dir)))
-            return
+            return []
         is_leaf_src = is_leaf(src_dir)
         is_leaf_dst = is_leaf(dst_dir)
+        subpaths = []
         if not is_leaf_src and not is_leaf_dst:
             if (src_dir['0/'][1] - dst_dir['0/'][1]) > MAX_DIR_SIZE:
                 logging.error("too many, skiped: %s %s(%s) %s(%s)", path,
                               src, src_dir['0/'][1],
                               dst, dst_dir['0/'][1])
-                return
+                return []
             for k in sorted(src_dir):
                 if src_dir[k] != dst_dir.get(k, (0, 0)):
-                    self.mirror(src, dst, path + k[0])
+                    subpaths.append(path + k[0])
         elif is_leaf_src and is_leaf_dst:
             #logging.info("file2file %s, %s => %s", path, src, dst)
             self.mirror_leaf(path, src, dst, src_dir, dst_dir, True)
@@ -608,6 +887,7 @@ class SyncWorker(object):
             self.mirror_nonleaf2leaf(path, src, dst, src_dir, dst_dir)
         else:
             self.mirror_nonleaf2leaf(path, dst, src, dst_dir, src_dir)
+        return subpaths
 
     def mirror_nonleaf2leaf(self, path, src, dst, src_dir, dst_dir):
         logging.info("dir2file %s, %s => %s", path, dst, src)
@@ -621,6 +901,7 @@ class SyncWorker(object):
 
     def mirror_leaf(self, path, src, dst, src_dir, dst_dir, sync_diff_value=False):
         # logging.debug("mirror_file %s %s %s", path, src.addr, dst.addr)
+        conflicts = []
         for khash_str, (src_vhash, src_ver) in src_dir.iteritems():
             dst_meta = dst_dir.get(khash_str)
 
@@ -647,4 +928,125 @@ class SyncWorker(object):
             cf = Conflict(self, tag, khash_str)
             cf.add(Copy(src, src_ver, src_vhash))
             cf.add(Copy(dst, dst_ver, dst_vhash))
-            cf.resolve()
+            conflicts.append(cf)
+        self.resolve_conflicts(conflicts)
+
+
+def get_bucket_root(bucket, depth):
+    '''return (path, name) of the bucket in the htree, e.g. ("@1", "a/")'''
+    if depth == 1:
+        return "@", "%x/" % bucket
+    return "@%x" % (bucket / 16), "%x/" % (bucket % 16)
+
+
+class SyncScheduler(object):
+    '''run the SyncWorkers of many buckets in one process
+
+    each round, the (hash, count) of every bucket root is read from one
+    @ listing per server. buckets whose roots are the same on all
+    primaries and have nothing on backups are skipped, the others run
+    run_once on a thread pool, the most different and stalest first.
+    no more than server_limit workers use a server at once.'''
+
+    def __init__(self, workers, num_threads=8, server_limit=2,
+                 interval=LOOP_INTERVAL):
+        self.workers = workers
+        self.num_threads = num_threads
+        self.server_limit = server_limit
+        self.interval = interval
+        self.clients = dict()
+        # made up front, workers run on many threads
+        self.semaphores = dict()
+        for w in workers:
+            for addr in w.formal_primaries | w.formal_backups:
+                if addr not in self.semaphores:
+                    self.semaphores[addr] = threading.BoundedSemaphore(server_limit)
+        self.is_running = False
+
+    def get_dir(self, addr, path):
+        client = self.clients.get(addr)
+        if client is None:
+            client = self.clients[addr] = DBClient(addr)
+        return client.get_dir(path)
+
+    def get_roots(self):
+        '''return {(addr, path): dir} of all the bucket roots'''
+        roots = dict()
+        for w in self.workers:
+            path, _ = get_bucket_root(w.bucket, w.depth)
+            for addr in w.formal_primaries | w.formal_backups:
+                if (addr, path) not in roots:
+                    roots[(addr, path)] = self.get_dir(addr, path)
+        return roots
+
+    def get_diff(self, worker, roots):
+        '''return the difference of the bucket root among servers,
+        0 means no need to sync'''
+        path, name = get_bucket_root(worker.bucket, worker.depth)
+        metas = [roots[(addr, path)].get(name) for addr in worker.formal_primaries]
+        if any(m is None for m in metas):
+            return MAX_DIR_SIZE  # let the worker find out
+        counts = [c for (_, c) in metas]
+        diff = max(counts) - min(counts)
+        if len(set(metas)) > 1:
+            diff += 1
+        for addr in worker.formal_backups:
+            meta = roots[(addr, path)].get(name)
+            if meta is None or meta[1] > 0:
+                diff += 1 if meta is None else meta[1]
+        return diff
+
+    def schedule(self):
+        '''return workers to run this round, in order'''
+        roots = self.get_roots()
+        now = time.time()
+        todo = []
+        for w in self.workers:
+            diff = self.get_diff(w, roots)
+            if diff == 0:
+                w.last_run = now
+                continue
+            todo.append((diff, now - w.last_run, w))
+        todo.sort(key=lambda x: x[:2], reverse=True)
+        return [w for (_, _, w) in todo]
+
+    def run_worker(self, worker):
+        addrs = sorted(worker.formal_primaries | worker.formal_backups)
+        for addr in addrs:
+            self.semaphores[addr].acquire()
+        try:
+            worker.is_running = self.is_running
+            worker.run_once()
+        except SystemExit:
+            logging.info("max_count %d reached, stop", SyncWorker.max_count)
+            self.stop()
+        finally:
+            # do not keep idle threads and their clients between rounds
+            worker.close_pool()
+            worker.release_clients()
+            for addr in reversed(addrs):
+                self.semaphores[addr].release()
+
+    def stop(self):
+        self.is_running = False
+        for w in self.workers:
+            w.is_running = False
+
+    def loop(self):
+        self.is_running = True
+        pool = ThreadPool(self.num_threads)
+        try:
+            while self.is_running:
+                try:
+                    todo = self.schedule()
+                except Exception, e:
+                    logging.getLogger().exception(e)
+                    todo = []
+                logging.info("SCHEDULE %d/%d buckets to sync", len(todo), len(self.workers))
+                if todo:
+                    pool.map(self.run_worker, todo, chunksize=1)
+                elif self.is_running:
+                    time.sleep(self.interval)
+        finally:
+            pool.close()
+            pool.join()
@@ -195,7 +195,7 @@ class ZK(object):
         for p in paths:
             self.zk.ensure_path(p)
         if state == "block":
-            busy = [p for p in paths if self.zk.get(p) == "busy"]
+            busy = [p for p in paths if self.zk.get(p)[0] == "busy"]
             if len(busy) > 0:
                 return busy
         for p in paths:
@@ -206,7 +206,7 @@ class ZK(object):
         path = self._path_gc_bucket(host, bucket)
         self.zk.ensure_path(path)
         if state == "block":
-            busy = path if self.zk.get(path) == "busy" else ""
+            busy = path if self.zk.get(path)[0] == "busy" else ""
             if busy:
                 return busy
         self.zk.set(path, state)
@@ -220,6 +220,11 @@ class ZK(object):
         if self.zk.exists(path):
             return self.zk.get_children(path)
 
+    def gc_get_host(self, host):
+        """ return {bucket_str: state} of host """
+        buckets = self.gc_get_status(host) or []
+        return dict([(b, self.gc_get_bucket(host, b)) for b in buckets])
+
     def gc_unblock_bucket(self, host, bucket):
         stats = self.gc_get_bucket(host, bucket)
         if stats == 'block':
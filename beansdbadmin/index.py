@@ -1,19 +1,25 @@
 # coding: utf-8
 import os
 import beansdbadmin
-from flask import Flask
+from flask import Flask, request
 from flask import render_template as tmpl
 
-from beansdbadmin.tools.gc import GCRecord, SQLITE_DB_PATH, update_gc_status
-from beansdbadmin.models.server import (
-    get_all_server_stats, get_all_buckets_key_counts, get_all_buckets_stats)
+from beansdbadmin.tools.gc import (
+    GCRecord, SQLITE_DB_PATH, GC_RECORD_PAGE_SIZE)
 from beansdbadmin.models.proxy import Proxies
+from beansdbadmin.models.snapshot import get_snapshot
 import beansdbadmin.config as config
 
 
 app = Flask(__name__)
 module_path = os.path.dirname(beansdbadmin.__file__)
 app.template_folder = os.path.join(module_path, 'templates')
+snapshot = get_snapshot()
+
+
+def tmpl_snapshot(template, name, **kwargs):
+    entry = snapshot.get(name)
+    return tmpl(template, snapshot=entry, **kwargs)
 
 
 @app.route('/')
@@ -24,30 +30,33 @@ def index():
 
 @app.route('/gc/')
 def gc():
+    page = request.args.get('page', 0, type=int)
+    snapshot.start()  # records are updated by the collector thread
     gc_record = GCRecord(SQLITE_DB_PATH)
-    update_gc_status(gc_record)
-    records = gc_record.get_all()
-    return tmpl('gc.html', gc_records=sorted(records, reverse=True))
+    records = gc_record.get_page(page)
+    num_pages = (gc_record.count() - 1) // GC_RECORD_PAGE_SIZE + 1
+    gc_record.close()
+    return tmpl('gc.html', gc_records=records, page=page, num_pages=num_pages,
+                snapshot=snapshot.entries['gc'])
 
 
 @app.route('/servers/')
 def servers():
-    server_infos = get_all_server_stats()
-    ss = [s.summary_server() for s in server_infos]
-    return tmpl('servers.html', servers=ss)
+    ss = snapshot.get('servers').value or []
+    return tmpl_snapshot('servers.html', 'servers', servers=ss)
 
 
 @app.route('/buckets/')
 def buckets():
-    server_buckets = get_all_buckets_stats(2)
-    return tmpl('buckets.html', server_buckets=server_buckets)
+    server_buckets = snapshot.get('buckets').value or []
+    return tmpl_snapshot('buckets.html', 'buckets', server_buckets=server_buckets)
 
 
 @app.route('/sync/')
 def sync():
-    bs = get_all_buckets_key_counts(256)
+    bs = snapshot.get('sync').value or []
     # bs = get_all_buckets_key_counts(256 if config.cluster=="fs" else 16)
-    return tmpl('sync.html', buckets=bs)
+    return tmpl_snapshot('sync.html', 'sync', buckets=bs)
 
 
 def generate_proxies(is_online):
@@ -58,13 +67,11 @@ def generate_proxies(is_online):
 
 
 def process_proxies(is_online):
-    proxies = generate_proxies(is_online)
-    stats = proxies.get_stats()
-    scores_summary = proxies.get_scores_summary()
-    return tmpl('proxies.html',
-                stats=stats,
-                scores=scores_summary,
-                is_online=is_online)
+    stats, scores_summary = snapshot.get('proxies').value or ([], [])
+    return tmpl_snapshot('proxies.html', 'proxies',
+                         stats=stats,
+                         scores=scores_summary,
+                         is_online=is_online)
 
 
 def process_scores(server, is_online):
@@ -11,6 +11,7 @@ from beansdbadmin.core.node import Node
 from beansdbadmin.models.utils import big_num, get_start_time, grouper
 from beansdbadmin.config import get_proxies
 from beansdbadmin.core.client import get_url_content
+from beansdbadmin.core.http_pool import get_urls
 
 PROXY_SERVER_PORT = 7905
 PROXY_WEB_PORT = 7908
@@ -28,8 +29,11 @@ class Proxy(object):
         self.web_addr = '%s:%s' % (self.host, PROXY_WEB_PORT)
         self.server = libmc.Client([self.server_addr])
 
+    def get_info_url(self, name):
+        return 'http://%s/%s' % (self.web_addr, name)
+
     def get_info(self, name):
-        url = 'http://%s/%s' % (self.web_addr, name)
+        url = self.get_info_url(name)
         try:
             data = json.loads(get_url_content(url))
         except Exception:
@@ -75,10 +79,22 @@ class Proxies(object):
     def get_proxy_hosts(self):
         return [p.host for p in self.proxies]
 
+    def get_infos(self, name):
+        ''' return [(proxy, info)] of all proxies, fetched concurrently '''
+        contents = get_urls([p.get_info_url(name) for p in self.proxies])
+        res = []
+        for p, content in zip(self.proxies, contents):
+            try:
+                data = json.loads(content)
+            except Exception:
+                data = {}
+            res.append((p, data))
+        return res
+
     def get_scores(self, server):
         rs = collections.defaultdict(dict)
-        for p in self.proxies:
-            for bkt, server_scores in p.get_score().iteritems():
+        for p, scores in self.get_infos('score/json'):
+            for bkt, server_scores in scores.iteritems():
                 addr = '%s:7900' % (server)
                 if addr in server_scores:
                     sorted_server_scores = sorted(server_scores.iteritems(),
@@ -92,8 +108,8 @@ class Proxies(object):
 
     def get_arcs(self, server):
         rs = collections.defaultdict(dict)
-        for p in self.proxies:
-            for bkt, server_arcs in p.get_arc().iteritems():
+        for p, arcs in self.get_infos('/api/partition'):
+            for bkt, server_arcs in arcs.iteritems():
                 addr = '%s:7900' % (server)
                 if addr in server_arcs:
                     sorted_server_arcs = sorted(server_arcs.iteritems(),
@@ -108,8 +124,8 @@ class Proxies(object):
     def get_scores_summary(self):
         rs = {}
         host_bkts = collections.defaultdict(set)
-        for p in self.proxies:
-            for bkt, server_scores in p.get_score().iteritems():
+        for p, scores in self.get_infos('score/json'):
+            for bkt, server_scores in scores.iteritems():
                 sorted_server_scores = sorted(server_scores.iteritems(),
                                               key=itemgetter(1),
                                               reverse=True)
@@ -145,39 +145,45 @@ class Bucket(object):
         return "(%s %s %s)" % (self.bucket_id, self.servers, self.backups)
 
 
-def get_key_counts(mc, path, base=0):
-    d = mc.get_dir("@" + path)
+def dir_to_counts(d, base=0):
     items = sorted(list(d.items()))
     counts = [v[1] for (_, v) in items]
     return dict([(base + i, c) for (i, c) in enumerate(counts) if c > 0])
 
 
+def get_key_counts(mc, path, base=0):
+    return dir_to_counts(mc.get_dir("@" + path), base)
+
+
 def get_buckets_key_counts(host, n):
     mc = DBClient(host + ":7900")
     d16 = get_key_counts(mc, "")
-    # print d16
     if n == 16:
         return d16
-    else:
-        mc = DBClient(host + ":7900")
-        d256 = dict()
-        for i, _ in d16.items():
-            subd = get_key_counts(mc, "%x" % i, 16 * i)
-            d256.update(subd)
-        return d256
+    # fetch all the sub buckets in one request
+    paths = ["@%x" % i for i in sorted(d16)]
+    dirs = mc.get_dir_multi(paths) if paths else {}
+    d256 = dict()
+    for i in d16:
+        d256.update(dir_to_counts(dirs["@%x" % i], 16 * i))
+    return d256
 
 
 def get_all_buckets_key_counts(n):
     buckets = [Bucket(n, i) for i in range(n)]
     primaries, backups = get_servers()
-    for h in primaries:
-        d = get_buckets_key_counts(h, n)
-        for bkt, count in d.items():
-            buckets[bkt].servers.append((h, count))
-    for h in backups:
-        d = get_buckets_key_counts(h, n)
+    hosts = primaries + backups
+    pool = ThreadPool(8)
+    results = pool.map(partial(get_buckets_key_counts, n=n), hosts)
+    pool.close()
+    pool.join()
+    for i, (h, d) in enumerate(zip(hosts, results)):
+        is_backup = i >= len(primaries)
         for bkt, count in d.items():
-            buckets[bkt].backups.append((h, count))
+            if is_backup:
+                buckets[bkt].backups.append((h, count))
+            else:
+                buckets[bkt].servers.append((h, count))
     for bkt in buckets:
         bkt.compute()
     buckets.sort(key=lambda x: x.cmpkey, reverse=True)
@@ -0,0 +1,152 @@
+# coding: utf-8
+"""
+cluster data shown by the dashboard, polled in background by a collector
+thread, so that page views do not hit every server. each source is
+refreshed on a thread of its own, so a slow one, e.g. sync, does not keep
+the others past their ttl.
+"""
+
+import time
+import logging
+import threading
+
+from beansdbadmin.models.server import (
+    get_all_server_stats, get_all_buckets_key_counts, get_all_buckets_stats)
+from beansdbadmin.models.proxy import Proxies
+from beansdbadmin.tools.gc import GCRecord, SQLITE_DB_PATH, update_gc_status
+
+logger = logging.getLogger(__name__)
+
+# seconds
+SNAPSHOT_TTLS = {
+    'servers': 60,
+    'buckets': 60,
+    'sync': 300,
+    'proxies': 60,
+    'gc': 60,
+}
+COLLECT_INTERVAL = 1
+COLLECT_RETRY = 30  # seconds after a failed collect, if less than the ttl
+
+
+def collect_servers():
+    return [s.summary_server() for s in get_all_server_stats()]
+
+
+def collect_buckets():
+    return get_all_buckets_stats(2)
+
+
+def collect_sync():
+    return get_all_buckets_key_counts(256)
+
+
+def collect_proxies():
+    proxies = Proxies()
+    return proxies.get_stats(), list(proxies.get_scores_summary())
+
+
+def collect_gc():
+    ''' update gc records in sqlite, pages read them from there '''
+    db = GCRecord(SQLITE_DB_PATH)
+    try:
+        update_gc_status(db)
+    finally:
+        db.close()
+
+
+class Entry(object):
+
+    def __init__(self, name, func, ttl):
+        self.name = name
+        self.func = func
+        self.ttl = ttl
+        self.value = None
+        self.time = 0  # of the last success
+        self.last_try = 0
+        self.err = None
+        self.lock = threading.Lock()
+
+    def is_expired(self, now=None):
+        now = now or time.time()
+        if self.err is not None:
+            return now - self.last_try >= min(self.ttl, COLLECT_RETRY)
+        return now - self.time >= self.ttl
+
+    def refresh(self, block=True):
+        ''' without block, return at once if it is being refreshed '''
+        if not self.lock.acquire(block):
+            return
+        try:
+            start = self.last_try = time.time()
+            try:
+                self.value = self.func()
+                self.time = time.time()
+                self.err = None
+            except Exception as e:
+                logger.exception("collect %s failed", self.name)
+                self.err = e
+            logger.info("collect %s %.2fs", self.name, time.time() - start)
+        finally:
+            self.lock.release()
+
+    def age(self):
+        return int(time.time() - self.time)
+
+
+class Snapshot(object):
+
+    def __init__(self, ttls=SNAPSHOT_TTLS):
+        self.entries = dict()
+        self.ttls = ttls
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def register(self, name, func, ttl=None):
+        if ttl is None:
+            ttl = self.ttls[name]
+        self.entries[name] = Entry(name, func, ttl)
+
+    def get(self, name):
+        """ return the Entry, with value, time and err, collect it at once
+            if it never has been, unless it is being or failed recently """
+        self.start()
+        entry = self.entries[name]
+        if not entry.time and entry.is_expired():
+            entry.refresh(block=False)
+        return entry
+
+    def collect(self):
+        ''' start a refresh thread for each expired entry not refreshing '''
+        now = time.time()
+        for entry in self.entries.values():
+            if entry.is_expired(now) and not entry.lock.locked():
+                t = threading.Thread(target=entry.refresh, args=(False,),
+                                     name="snapshot %s" % entry.name)
+                t.daemon = True
+                t.start()
+
+    def run(self):
+        while True:
+            try:
+                self.collect()
+            except Exception:
+                logger.exception("collect failed")
+            time.sleep(COLLECT_INTERVAL)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="snapshot")
+                self.thread.daemon = True
+                self.thread.start()
+
+
+def get_snapshot():
+    snapshot = Snapshot()
+    snapshot.register('servers', collect_servers)
+    snapshot.register('buckets', collect_buckets)
+    snapshot.register('sync', collect_sync)
+    snapshot.register('proxies', collect_proxies)
+    snapshot.register('gc', collect_gc)
+    return snapshot
@@ -6,9 +6,14 @@ import logging
 import sqlite3
 import getpass
 from pprint import pprint
-from beansdbadmin.core.server_info import (get_http, get_bucket_all, get_du)
+from contextlib import contextmanager
+from collections import Counter
+from multiprocessing.dummy import Pool as ThreadPool
+from beansdbadmin.core.server_info import (
+    get_http, get_bucket_all, get_bucket_all_multi, get_du)
+from beansdbadmin.core.node import Node
 from beansdbadmin.tools.logreport import send_sms
-from beansdbadmin.tools.filelock import FileLock
+from beansdbadmin.tools.filelock import FileLock, FileLockException
 from beansdbadmin import config
 
 logger = logging.getLogger('gc')
@@ -24,17 +29,27 @@ else:
     logging.basicConfig(level=logging.DEBUG, format=LOG_FORMAT)
 
 DISK_GC = (400 << 30)
+GC_ESTIMATE_SAMPLE = 16
+
+# gc scheduler daemon
+MAX_GC_RUNNING = 8
+MAX_GC_PER_SERVER = 1
+MAX_GC_PER_DISK = 1
+GC_SCHEDULE_INTERVAL = 60
+GC_LOCK_TIMEOUT = 10
 
 # gc record database
 
 
-def get_buckets(s):
+def get_gc_estimate(s, bucket):
+    ''' return (start, end, reclaim, io) estimated by the agent from hints,
+        None if unknown, or not estimated yet (it is done in background)'''
     try:
-        return get_bucket_all(s)
+        agent = Node("%s:7900" % s).agent_client()
+        res = agent.garbage('{:02x}'.format(bucket), GC_ESTIMATE_SAMPLE)
+        return res.get('best')
     except Exception as e:
-        logging.info("get buckets failed for %s" % s)
-        logging.exception(e)
-        return []
+        logging.info("get gc estimate failed for %s %s: %s", s, bucket, e)
 
 
 def get_disks(s):
@@ -46,10 +61,46 @@ def get_disks(s):
         return {}
 
 
+GC_RECORD_PAGE_SIZE = 100
+
+
 class GCRecord(object):
     def __init__(self, path):
         self.conn = sqlite3.connect(path)
         self.cursor = self.conn.cursor()
+        self.in_batch = False
+        # readers of the /gc/ page do not block the updater
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        if self.has_table():
+            self.create_index()
+
+    def has_table(self):
+        self.cursor.execute("SELECT name FROM sqlite_master "
+                            "WHERE type='table' AND name='gc_record'")
+        return self.cursor.fetchone() is not None
+
+    def create_index(self):
+        self.cursor.execute("""CREATE INDEX IF NOT EXISTS gc_record_bucket
+                            ON gc_record (server, bucket, start_time)""")
+        self.conn.commit()
+
+    def commit(self):
+        if not self.in_batch:
+            self.conn.commit()
+
+    @contextmanager
+    def batch(self):
+        ''' commit all the writes in the block at once '''
+        self.in_batch = True
+        try:
+            yield self
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            self.in_batch = False
 
     def create_table(self):
         self.cursor.execute("""CREATE TABLE gc_record (
@@ -65,7 +116,7 @@ class GCRecord(object):
                             size_broken INTEGER,
                             status TEXT)
                             """)
-        self.conn.commit()
+        self.create_index()
 
     def close(self):
         self.conn.close()
@@ -95,7 +146,7 @@ class GCRecord(object):
                 'size_broken': size_broken,
                 'status': status
             })
-        self.conn.commit()
+        self.commit()
 
     def update(self, id, stop_time, curr_id, size_released, size_broken,
                status):
@@ -113,7 +164,7 @@ class GCRecord(object):
                 'size_released': size_released,
                 'size_broken': size_broken
             })
-        self.conn.commit()
+        self.commit()
 
     def update_status(self, id, status):
         logging.debug("update status %s %s", id, status)
@@ -126,12 +177,30 @@ class GCRecord(object):
                 'id': id,
                 'stop_time': stop_time
             })
-        self.conn.commit()
+        self.commit()
 
     def get_all(self, num=256 * 3 * 2):
         self.cursor.execute("SELECT * FROM gc_record")
         return self.cursor.fetchall()
 
+    def count(self):
+        self.cursor.execute("SELECT COUNT(*) FROM gc_record")
+        return self.cursor.fetchone()[0]
+
+    def get_page(self, page=0, page_size=GC_RECORD_PAGE_SIZE):
+        ''' records of page, the newest first '''
+        self.cursor.execute(
+            "SELECT * FROM gc_record ORDER BY id DESC LIMIT ? OFFSET ?",
+            (page_size, page * page_size))
+        return self.cursor.fetchall()
+
+    def get_most_recent(self):
+        ''' the newest record of each (server, bucket) '''
+        self.cursor.execute("""SELECT * FROM gc_record WHERE id IN
+                            (SELECT MAX(id) FROM gc_record
+                            GROUP BY server, bucket)""")
+        return self.cursor.fetchall()
+
 
 def get_servers(exclude):
     exclude.extend(["chubb2", "chubb3"])
@@ -164,6 +233,10 @@ def main():
                         '--update-status',
                         action='store_true',
                         help="Update the status of gc.")
+    parser.add_argument('-D',
+                        '--daemon',
+                        action='store_true',
+                        help="Keep gc running on several servers at once.")
     args = parser.parse_args()
 
     gc_record = GCRecord(SQLITE_DB_PATH)
@@ -176,7 +249,13 @@ def main():
         return
     config.cluster = args.cluster  # use for get_servers_from_zk
 
-    with FileLock(SQLITE_DB_PATH, timeout=10):
+    if args.daemon:
+        # only one daemon, it takes the db lock per round
+        with FileLock(SQLITE_DB_PATH + ".daemon", timeout=GC_LOCK_TIMEOUT):
+            GCScheduler(gc_record, args.debug).loop()
+        return
+
+    with FileLock(SQLITE_DB_PATH, timeout=GC_LOCK_TIMEOUT):
         if args.update_status:
             update_gc_status(gc_record)
             return
@@ -186,19 +265,13 @@ def main():
 def choose_one_bucket_and_gc_it(debug=False):
     servers = get_servers(config.IGNORED_SERVERS)
     disks = []
-    buckets = []
-    for s in servers:
-        for bkt in get_buckets(s):
-            bkt_id = bkt["ID"]
-            gcing = (bkt["HintState"] >= 4)
-            if gcing:
-                if not debug:
-                    logging.info("%s %s is gcing", s, bkt_id)
-                    return
-
-        for disk, disk_info in get_disks(s)["Disks"].iteritems():
-            disk_free = disk_info["Free"]
-            disk_buckets = disk_info["Buckets"]
+    for s, gcing, server_disks in get_all_server_gc_states(servers):
+        if gcing and not debug:
+            logging.info("%s %s is gcing", s, sorted(gcing))
+            return
+        if gcing is None:
+            logging.warning("%s: buckets unknown, taken as not gcing", s)
+        for disk, disk_free, disk_buckets in server_disks:
             if DISK_GC > disk_free > 0:
                 disks.append((s, disk_free, disk_buckets))
 
@@ -207,23 +280,188 @@ def choose_one_bucket_and_gc_it(debug=False):
     disks.sort(key=lambda x: x[1])
     gc_disk = disks[0]
     block_buckets = config.gc_block_buckets(gc_disk[0])
-    for bucket in gc_disk[-1]:
+    buckets = get_gc_candidates(gc_disk[0], gc_disk[-1], block_buckets)
+    if not buckets:
+        alarm_disk_full(gc_disk[0])
+        return
+    server, bucket, _, estimate = buckets[0]
+    if estimate:
+        start, end, reclaim, io = estimate
+        logging.info("gc %s %s chunks %d-%d, reclaim %d, io %d",
+                     server, bucket, start, end, reclaim, io)
+        gc_bucket(server, bucket, debug, start, end)
+    else:
+        gc_bucket(server, bucket, debug)
+
+
+def alarm_disk_full(server):
+    msg = "server %s:beansdb takes too much disk space \
+           and is not cleard when autogc" % server
+    logging.error(msg)
+    send_sms(msg)
+
+
+def get_gc_candidates(server, disk_buckets, block_buckets):
+    ''' return [(server, bucket, gc_files, estimate)] of disk_buckets,
+        the best first: most reclaimable bytes per byte of io if estimated,
+        or most gc files'''
+    buckets = []
+    for bucket in disk_buckets:
         bkt = '{:02x}'.format(bucket)
         if block_buckets and bkt in block_buckets:
             continue
-        bucket_gc_files = get_gc_files(gc_disk[0], bucket)
+        bucket_gc_files = get_gc_files(server, bucket)
         if bucket_gc_files:
-            buckets.append((gc_disk[0], bucket, bucket_gc_files))
+            estimate = get_gc_estimate(server, bucket)
+            buckets.append((server, bucket, bucket_gc_files, estimate))
+
+    def rank(b):
+        estimate = b[-1]
+        if estimate:
+            return (1, float(estimate[2]) / estimate[3])
+        return (0, b[2])
+    buckets.sort(key=rank, reverse=True)
+    return buckets
 
-    if not buckets:
-        msg = "server %s:beansdb takes too much disk space \
-               and is not cleard when autogc" % gc_disk[0]
-        logging.error(msg)
-        send_sms(msg)
-        return
-    buckets.sort(key=lambda x: x[-1], reverse=True)
-    server, bucket, _ = buckets[0]
-    gc_bucket(server, bucket, debug)
+
+def get_server_gc_state(server):
+    ''' return (server, ids of gcing buckets, [(disk, free, buckets)]),
+        gcing buckets is None if unknown, the disks are still got'''
+    try:
+        buckets = get_bucket_all(server)
+        gcing = set([b["ID"] for b in buckets if b["HintState"] >= 4])
+    except Exception:
+        logging.exception("get buckets failed for %s, gcing unknown", server)
+        gcing = None
+    disks = get_disks(server).get("Disks", {})
+    return server, gcing, [(d, info["Free"], info["Buckets"])
+                           for (d, info) in disks.iteritems()]
+
+
+def get_all_server_gc_states(servers):
+    pool = ThreadPool(8)
+    states = pool.map(get_server_gc_state, servers)
+    pool.close()
+    pool.join()
+    return states
+
+
+class GCScheduler(object):
+    '''keep gc running on several servers at once, at most max_per_server
+    on a server and max_per_disk on a disk, the disks with the least free
+    space first. buckets blocked in zk (by migration) are skipped, and
+    buckets gc-ed by us are marked busy in zk until done.'''
+
+    def __init__(self, db, debug=False, max_running=MAX_GC_RUNNING,
+                 max_per_server=MAX_GC_PER_SERVER,
+                 max_per_disk=MAX_GC_PER_DISK,
+                 interval=GC_SCHEDULE_INTERVAL):
+        self.db = db
+        self.debug = debug
+        self.max_running = max_running
+        self.max_per_server = max_per_server
+        self.max_per_disk = max_per_disk
+        self.interval = interval
+        self.running = dict()  # (server, bucket id) -> disk
+
+    def set_zk_state(self, server, bucket, state):
+        if not self.debug:
+            config.get_zk().gc_set_bucket(server, '{:02x}'.format(bucket), state)
+
+    def mark_busy(self, server, bucket):
+        ''' return False if blocked since zk states were read '''
+        if self.debug:
+            return True
+        bkt = '{:02x}'.format(bucket)
+        if config.get_zk().gc_get_host(server).get(bkt, "idle") != "idle":
+            return False
+        self.set_zk_state(server, bucket, "busy")
+        return True
+
+    def update_running(self, server, gcing, zk_states):
+        for (s, bucket) in self.running.keys():
+            if s == server and bucket not in gcing:
+                logging.info("gc %s %s done", s, bucket)
+                self.running.pop((s, bucket))
+                self.set_zk_state(s, bucket, "idle")
+        # left busy by a previous run
+        for bkt, state in zk_states.items():
+            bucket = int(bkt, 16)
+            if (state == "busy" and bucket not in gcing and
+                    (server, bucket) not in self.running):
+                self.set_zk_state(server, bucket, "idle")
+                zk_states[bkt] = "idle"
+
+    def start_gc(self, server, disk, disk_buckets, zk_states):
+        skip = [b for (b, state) in zk_states.items() if state != "idle"]
+        buckets = get_gc_candidates(server, disk_buckets, skip)
+        if not buckets:
+            alarm_disk_full(server)
+            return False
+        for _, bucket, _, estimate in buckets:
+            start, end = estimate[:2] if estimate else (None, None)
+            if not self.mark_busy(server, bucket):
+                continue
+            if gc_bucket(server, bucket, self.debug, start, end):
+                self.running[(server, bucket)] = disk
+                return True
+            self.set_zk_state(server, bucket, "idle")
+        return False
+
+    def schedule(self):
+        zk = config.get_zk()
+        servers = get_servers(list(config.IGNORED_SERVERS))
+        on_server = Counter()
+        on_disk = Counter()
+        disks = []
+        server_zk_states = dict()
+        for server, gcing, server_disks in get_all_server_gc_states(servers):
+            if gcing is None:
+                # its running gcs are unknown, do not count them as done,
+                # nor start more beyond max_per_server
+                logging.warning("skip %s this round, buckets unknown: "
+                                "disks %s", server,
+                                [(d, free) for (d, free, _) in server_disks])
+                continue
+            zk_states = zk.gc_get_host(server)
+            server_zk_states[server] = zk_states
+            self.update_running(server, gcing, zk_states)
+            disk_of = dict()
+            for (disk, free, buckets) in server_disks:
+                for b in buckets:
+                    disk_of[b] = disk
+                if DISK_GC > free > 0:
+                    disks.append((free, server, disk, buckets))
+            for b in gcing:
+                on_server[server] += 1
+                on_disk[(server, disk_of.get(b))] += 1
+
+        disks.sort()
+        total = sum(on_server.values())
+        for (free, server, disk, buckets) in disks:
+            if total >= self.max_running:
+                break
+            if (on_server[server] >= self.max_per_server or
+                    on_disk[(server, disk)] >= self.max_per_disk):
+                continue
+            if self.start_gc(server, disk, buckets, server_zk_states[server]):
+                total += 1
+                on_server[server] += 1
+                on_disk[(server, disk)] += 1
+
+    def loop(self):
+        ''' the db lock is only held during a round, so that cron runs of
+            --update-status or one-shot gc still get it in between'''
+        while True:
+            try:
+                with FileLock(SQLITE_DB_PATH, timeout=GC_LOCK_TIMEOUT):
+                    self.schedule()
+                    update_gc_status(self.db)
+            except FileLockException:
+                logging.info("gc db is locked by another run, skip a round")
+            except Exception:
+                logging.exception("gc schedule failed")
+            time.sleep(self.interval)
 
 
 def get_status(gc):
@@ -268,8 +506,13 @@ def insert_rec(db, server, bucket, gc):
 
 def update_gc_status(db):
     servers = get_servers([])
-    indb = get_most_recent_for_buckets(db)
     online = get_gc_stats_online(servers)
+    with db.batch():
+        _update_gc_status(db, online)
+
+
+def _update_gc_status(db, online):
+    indb = get_most_recent_for_buckets(db)
 
     for bkt, old in indb.items():
         if bkt not in online:
@@ -290,26 +533,26 @@ def update_gc_status(db):
 
 
 def get_most_recent_for_buckets(db):
-    records = db.get_all()
-    records.sort()
     buckets = dict()
-    for r in records:
+    for r in db.get_most_recent():
         key = (r[1], int(r[2]))  # (server, bucket id)
         buckets[key] = r
     return buckets
 
 
 def get_gc_stats_online(servers):
+    ''' fetch bucket stats of all servers concurrently,
+        servers failed or timed out are left out'''
     buckets = dict()
-    for s in servers:
-        try:
-            for bkt in get_buckets(s):
-                bkt_id = bkt["ID"]
-                lastgc = bkt["LastGC"]
-                if lastgc:
-                    buckets[(s, bkt_id)] = lastgc
-        except Exception:
-            pass
+    for s, bkts in get_bucket_all_multi(servers).items():
+        if isinstance(bkts, Exception):
+            logging.info("get buckets failed for %s: %s", s, bkts)
+            continue
+        for bkt in bkts:
+            bkt_id = bkt["ID"]
+            lastgc = bkt["LastGC"]
+            if lastgc:
+                buckets[(s, bkt_id)] = lastgc
     return buckets
 
 
@@ -322,18 +565,24 @@ def get_gc_files(server, bucket):
         return 0
 
 
-def gc_bucket(server, bucket, debug=True):
+def gc_bucket(server, bucket, debug=True, start=None, end=None):
+    query = "/gc/%x" % int(bucket)
+    if start is not None:
+        query += "?start=%d&end=%d" % (start, end)
     if debug:
+        # without run=true, the server only tells what it would gc
         print "pretend gc %s %s" % (server, bucket)
-        res = get_http(server, "/gc/%x" % int(bucket))
+        res = get_http(server, query)
         print res
-        return
-    res = get_http(server, "/gc/%x?run=true" % int(bucket))
+        return parse_gc_resp(res)[2]
+    query += "&run=true" if "?" in query else "?run=true"
+    res = get_http(server, query, retry=False)
     _, _, ok = parse_gc_resp(res)
     if not ok:
         logging.error("gc %s %s: %s", server, bucket, res)
     else:
         logging.info("gc %s %s: %s", server, bucket, res)
+    return ok
 
 
 def get_sentence(s, key):
@@ -25,6 +25,9 @@ setup(
         'kazoo',
         'mmh3',
     ],
+    extras_require={
+        'numpy': ['numpy'],  # columnar hint decoding
+    },
     ext_modules=[
         Extension('beansdbadmin.core.fnv1a', ['beansdbadmin/core/fnv1a.c']),
     ],
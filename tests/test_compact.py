@@ -0,0 +1,112 @@
+# coding: utf-8
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from beansdbadmin.core import compact
+from beansdbadmin.core.data import DataFile, write_record, R_KEY, R_VER
+from beansdbadmin.core.export import get_data_chunks
+from beansdbadmin.core.hint import HintFile, get_keyinfo_from_hint
+from beansdbadmin.core.hash import get_khash64
+
+
+def latest(bucket_dir):
+    ''' the newest record of each key not deleted '''
+    recs = {}
+    chunks = get_data_chunks(bucket_dir)
+    for chunk in sorted(chunks):
+        with DataFile(chunks[chunk], decompress_value=False) as f:
+            for _, rec in f:
+                recs[rec[R_KEY]] = rec
+    return dict((key, rec) for key, rec in recs.items() if rec[R_VER] > 0)
+
+
+class Crash(Exception):
+    pass
+
+
+class CompactorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.bucket = os.path.join(self.dir, '2')
+        os.makedirs(self.bucket)
+        ver = {}
+        for chunk in range(3):
+            path = os.path.join(self.bucket, '%03d.data' % chunk)
+            with open(path, 'wb') as f:
+                for i in range(60):
+                    # a third of the keys rewritten in each chunk
+                    key = 'key%d' % ((chunk * 40 + i) % 100)
+                    ver[key] = ver.get(key, 0) + 1
+                    value = 'v%d-%d-' % (chunk, i) * (i + 1)
+                    write_record(f, key, value, 0, 1000 + chunk, ver[key])
+                for i in range(0, 100, 9):
+                    key = 'key%d' % i
+                    ver[key] = ver.get(key, 0) + 1
+                    write_record(f, key, '', 0, 2000 + chunk, -ver[key])
+        self.out = self.bucket + '.compact'
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_output(self):
+        expect = latest(self.bucket)
+        self.assertTrue(expect)
+        self.assertEqual(latest(self.out), expect)
+        with open(os.path.join(self.out, compact.STATE_FILE)) as f:
+            self.assertEqual(json.load(f)['step'], compact.STEP_DONE)
+        live_dir = os.path.join(self.out, compact.LIVE_DIR)
+        self.assertFalse(os.path.exists(live_dir))
+        chunks = get_data_chunks(self.out)
+        n = 0
+        for chunk in chunks:
+            path = os.path.join(self.out, '%03d.000.idx.s' % chunk)
+            for key, (khash, pos, ver, _), _ in HintFile(path):
+                self.assertEqual(khash, get_khash64(key))
+                self.assertEqual(ver, expect[key][R_VER])
+                self.assertEqual(get_keyinfo_from_hint(path, key)[0], pos)
+                n += 1
+        self.assertEqual(n, len(expect))
+
+    def test_compact(self):
+        stats = compact.Compactor(self.bucket, max_file_size=4096).run()
+        self.assertEqual(stats['bad'], 0)
+        self.assertEqual(stats['count'], len(latest(self.bucket)))
+        self.check_output()
+
+    def test_restart(self):
+        write = compact.ChunkWriter.write
+        count = [0]
+
+        def crash(writer, rec):
+            count[0] += 1
+            if count[0] == 50:
+                raise Crash()
+            return write(writer, rec)
+
+        compact.ChunkWriter.write = crash
+        try:
+            self.assertRaises(Crash, compact.Compactor(
+                self.bucket, max_file_size=4096).run)
+        finally:
+            compact.ChunkWriter.write = write
+        with open(os.path.join(self.out, compact.STATE_FILE)) as f:
+            state = json.load(f)
+        self.assertEqual(state['step'], compact.STEP_COPY)
+        self.assertTrue(state['out_chunk'] > 0)
+
+        compact.Compactor(self.bucket, max_file_size=4096).run()
+        self.check_output()
+
+    def test_restart_done(self):
+        compact.Compactor(self.bucket, max_file_size=4096).run()
+        stats = compact.Compactor(self.bucket, max_file_size=4096).run()
+        self.assertEqual(stats['count'], 0)
+        self.check_output()
+
+
+if __name__ == '__main__':
+    unittest.main()
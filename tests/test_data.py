@@ -0,0 +1,111 @@
+# coding: utf-8
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from beansdbadmin.core.data import DataFile, write_record
+
+
+class ResyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, '000.data')
+        self.pos = []
+        off = 0
+        with open(self.path, 'wb') as f:
+            for i in range(200):
+                self.pos.append(off)
+                off += write_record(f, 'key%d' % i, 'v' * (i * 37 % 900),
+                                    0, 1, 1)
+        self.pos.append(off)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def corrupt(self):
+        with open(self.path, 'rb') as f:
+            data = bytearray(f.read())
+        pos = self.pos
+        # insane sizes at record 10, records 50..59 zeroed, a bad crc at 100
+        struct.pack_into('II', data, pos[10] + 16, 7, 12345)
+        data[pos[50]:pos[60]] = '\0' * (pos[60] - pos[50])
+        data[pos[100] + 30] ^= 1
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        return [(pos[10], pos[11]), (pos[50], pos[60]), (pos[100], pos[101])]
+
+    def scan(self, **kw):
+        with DataFile(self.path, stop_on_bad=False, resync=True, **kw) as f:
+            recs = list(f)
+            return recs, f.skipped, f.num_bad
+
+    def test_clean(self):
+        for use_mmap in (False, True):
+            recs, skipped, num_bad = self.scan(use_mmap=use_mmap)
+            self.assertEqual([pos for pos, _ in recs], self.pos[:-1])
+            self.assertEqual((skipped, num_bad), ([], 0))
+
+    def test_resync(self):
+        bad = self.corrupt()
+        lost = set([10, 100] + range(50, 60))
+        expect = ['key%d' % i for i in range(200) if i not in lost]
+        for use_mmap in (False, True):
+            recs, skipped, num_bad = self.scan(use_mmap=use_mmap)
+            self.assertEqual([rec[0] for _, rec in recs if rec is not None],
+                             expect)
+            self.assertEqual(skipped, bad)
+            self.assertEqual(num_bad, 3)
+            self.assertEqual([pos for pos, rec in recs if rec is None],
+                             [start for start, _ in bad])
+
+    def test_truncated_tail(self):
+        with open(self.path, 'ab') as f:
+            f.write('\1' * 100)
+        recs, skipped, num_bad = self.scan()
+        self.assertEqual(len([r for _, r in recs if r is not None]), 200)
+        self.assertEqual(skipped, [(self.pos[-1], self.pos[-1] + 100)])
+
+    def test_read_error(self):
+        # a bad sector under record 150, read by the file reader
+        pos = self.pos
+        bad_start, bad_end = pos[150], pos[150] + 300
+
+        class BadFile(object):
+
+            def __init__(self, f):
+                self.f = f
+                self.name = f.name
+
+            def __getattr__(self, name):
+                return getattr(self.f, name)
+
+            def read(self, n=-1):
+                start = self.f.tell()
+                end = start + n if n >= 0 else os.path.getsize(self.name)
+                if start < bad_end and end > bad_start:
+                    raise IOError(5, 'Input/output error')
+                return self.f.read(n)
+
+        f = DataFile(self.path, stop_on_bad=False, resync=True)
+        f.f = BadFile(f.f)
+        try:
+            keys = [rec[0] for _, rec in f if rec is not None]
+        finally:
+            f.close()
+        self.assertTrue(f.num_bad >= 1)
+        self.assertEqual(f.skipped[0][0], pos[150])
+        self.assertFalse('key150' in keys)
+        self.assertEqual(keys[:150], ['key%d' % i for i in range(150)])
+        self.assertEqual(keys[-1], 'key199')
+
+    def test_stop_on_bad(self):
+        self.corrupt()
+        with DataFile(self.path) as f:
+            self.assertRaises(Exception, list, f)
+
+
+if __name__ == '__main__':
+    unittest.main()
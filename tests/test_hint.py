@@ -0,0 +1,76 @@
+# coding: utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+from beansdbadmin.core.hash import get_khash64
+from beansdbadmin.core.hint import (
+    NewHintWriter, HintFile, HintIndex, write_new_hint, parse_new_hint,
+    get_keyinfo_from_hint, iter_new_hint_items, INDEX_INTERVAL)
+
+
+def make_items(n, chunk=3):
+    items = []
+    for i in range(n):
+        key = 'key_%d' % i + 'x' * (i % 40)
+        items.append((key, get_khash64(key), chunk, i * 256, i % 7 + 1,
+                      i & 0xffff))
+    return items
+
+
+class NewHintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, '003.000.idx.s')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_write_parse(self):
+        items = make_items(1000)
+        self.assertEqual(write_new_hint(self.path, items, 256000), 1000)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        with open(self.path) as f:
+            parsed = list(parse_new_hint(f.read()))
+        expect = sorted(items, key=lambda it: (it[1], it[3]))
+        self.assertEqual([(key, (khash, pos, ver, vhash))
+                          for key, khash, _, pos, ver, vhash in expect],
+                         [(key, meta) for key, meta, _ in parsed])
+
+    def test_index_lookup(self):
+        items = make_items(2000)
+        write_new_hint(self.path, items, 512000)
+        index = HintIndex().load(self.path)
+        self.assertEqual(index.count, 2000)
+        self.assertEqual(index.datasize, 512000)
+        # one index item every INDEX_INTERVAL bytes of items at least
+        self.assertTrue(len(index.khashes) > 1)
+        self.assertTrue(
+            len(index.khashes) <= index.index_off_s // INDEX_INTERVAL + 1)
+        self.assertEqual(index.khashes, sorted(index.khashes))
+        for key, _, _, pos, ver, vhash in items:
+            self.assertEqual(get_keyinfo_from_hint(self.path, key),
+                             (pos, ver, vhash))
+        self.assertEqual(get_keyinfo_from_hint(self.path, 'nokey'), None)
+
+    def test_stream_items(self):
+        write_new_hint(self.path, make_items(500), 128000)
+        self.assertEqual(list(iter_new_hint_items(self.path, block_size=100)),
+                         [(key, meta) for key, meta, _ in HintFile(self.path)])
+
+    def test_empty(self):
+        self.assertEqual(write_new_hint(self.path, [], 0), 0)
+        self.assertEqual(list(HintFile(self.path)), [])
+        self.assertEqual(get_keyinfo_from_hint(self.path, 'key'), None)
+
+    def test_abort(self):
+        w = NewHintWriter(self.path)
+        w.add(*make_items(1)[0])
+        w.abort()
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()